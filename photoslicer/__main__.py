@@ -1,7 +1,9 @@
 import os
 import sys
 import ntpath
+import threading
 import tkinter as tk
+from concurrent.futures import ThreadPoolExecutor, wait
 from tkinter import messagebox
 from tkinter import filedialog
 import PIL
@@ -9,6 +11,9 @@ from PIL import Image
 from PIL import ImageTk
 from autoslicer import Autoslicer, AutoslicerParams
 from slicingcanvas import SlicingCanvas, PhotoSlice
+from slicecache import SliceCache
+from prefetch import Prefetcher, PrefetchedScan
+from discovery import discover_images, unique_paths
 
 
 class DisableableFrame(tk.Frame):
@@ -64,7 +69,7 @@ class PhotoSlicer(DisableableFrame):
         tk.Label(self.frame_controls, text="Save Format").grid(row=row, column=0, sticky="w")
         
         row += 1
-        save_formats = ["jpg", "jpeg", "png"]
+        save_formats = ["jpg", "jpeg", "png", "webp"]
         default_format = tk.StringVar()
         default_format.set(self.save_format)
         self.save_format_dropdown = tk.OptionMenu(self.frame_controls, default_format, *save_formats, command=self.set_save_format)
@@ -84,6 +89,8 @@ class PhotoSlicer(DisableableFrame):
             row += 1
             p.control = tk.Spinbox(self.frame_controls, from_=p.min, to=p.max, increment=p.step, textvariable=p.tk_var)
             p.control.grid(row=row, column=0, sticky="we")
+            if pi not in self.params.ENCODER_PARAMS:
+                p.tk_var.trace_add("write", self.on_parameter_changed)
             row += 1
 
         # Set defaults
@@ -92,9 +99,18 @@ class PhotoSlicer(DisableableFrame):
         self.button_setdef.grid(row=row, column=0, sticky="we")
 
         row += 1
-        self.button_update = tk.Button(self.frame_controls, text="Detect pictures", command=self.update_preview)
+        self.button_update = tk.Button(self.frame_controls, text="Detect pictures", command=self.detect)
         self.button_update.grid(row=row, column=0, sticky="we")
 
+        row += 1
+        self.live_detect = tk.IntVar(value=0)
+        self.check_live = tk.Checkbutton(self.frame_controls, text="Live detection", variable=self.live_detect)
+        self.check_live.grid(row=row, column=0, sticky="w")
+
+        row += 1
+        self.button_abort = tk.Button(self.frame_controls, text="Abort detection", command=self.abort_processing)
+        self.button_abort.grid(row=row, column=0, sticky="we")
+
         row += 1
         self.button_addbox = tk.Button(self.frame_controls, text="Add manual bounding box", command=self.add_box)
         self.button_addbox.grid(row=row, column=0, sticky="we")
@@ -110,6 +126,20 @@ class PhotoSlicer(DisableableFrame):
         self.slicing_canvas.grid(row=0, column=1, sticky='nswe')
         self.slicing_canvas.update()
         self.autoslicer = Autoslicer(self.params)
+        # Tuning a parameter reruns only the stages from it on
+        self.autoslicer.cache_stages = True
+        self.cache = SliceCache()
+        self.prefetcher = Prefetcher(self.cache)
+        self.boxes = None
+        self.boxes_params = None
+
+        # Detection runs on a single worker thread, one run at a time; a newer run supersedes the one in flight
+        self.detection_executor = ThreadPoolExecutor(max_workers=1)
+        self.detection_future = None
+        self.detection_cancel = None
+        self.detection_generation = 0
+        self.detection_status = None
+        self.live_detect_after = None
 
     def update_statusbar(self, text):
         self.status_text.set(text)
@@ -120,6 +150,9 @@ class PhotoSlicer(DisableableFrame):
         if len(self.source_images) == 0:
             self.open_directory()
 
+        self.store_session()
+        left_index = self.source_index
+
         if self.source_index is None:
             self.source_index = 0
         else:
@@ -136,23 +169,169 @@ class PhotoSlicer(DisableableFrame):
                 return
 
         self.disable()
-        self.autoslicer.load_image(self.source_images[self.source_index])
+        # The worker must be done with the current scan before it is replaced
+        self.cancel_detection(wait_done=True)
+        if left_index is not None and left_index != self.source_index and self.boxes is not None:
+            # Keep the scan being left around, going back to it is then instant
+            left = Autoslicer(self.params)
+            left.adopt_image(self.autoslicer)
+            self.prefetcher.put(left.image_path, self.boxes_params, PrefetchedScan(left, self.boxes,
+                                                                                   self.slicing_canvas.image))
+            self.autoslicer.image = None
+
+        image_path = self.source_images[self.source_index]
+        scan = self.prefetcher.take(image_path, self.params)
+        if scan is not None:
+            self.autoslicer.adopt_image(scan.slicer)
+        else:
+            self.autoslicer.load_image(image_path)
         if self.autoslicer.image_loaded():
-            self.update_preview(new_image=True)
-            self.update_statusbar("Loaded " + self.source_images[self.source_index])
+            self.update_preview(new_image=True, prefetched=scan)
+            self.update_statusbar("Loaded " + image_path)
+        self.prefetcher.schedule(self.source_images, self.source_index, self.params)
         self.enable()
 
-    def update_preview(self, new_image=False):
+    def update_preview(self, new_image=False, prefetched=None):
         if not self.autoslicer.image_loaded():
             return
 
-        self.disable()
-        bbxs, image = self.autoslicer.autodetect_slices(self.update_statusbar)
-        self.slicing_canvas.set_image(Image.fromarray(image), new_image)
-        self.slicing_canvas.update_bboxes(bbxs)
+        if prefetched is not None:
+            # Detected in the background with the current parameters
+            _, slices = self.cache.load(self.autoslicer.image_path, self.params.detection_values())
+            self.show_detection(prefetched.preview, prefetched.boxes, slices, self.params.snapshot(), new_image,
+                                new_image)
+            return
+
+        if new_image:
+            # The scan shows right away, its slices once detected
+            self.slicing_canvas.set_image(Image.fromarray(self.autoslicer.preview_image()), True)
+            self.slicing_canvas.update_bboxes()
+            self.slicing_canvas.update_view()
+            self.boxes = None
+        self.start_detection(restore_slices=new_image)
+
+    def start_detection(self, restore_slices=False):
+        try:
+            params = self.params.snapshot()
+        except tk.TclError:
+            # A spinbox holds a partial value while being typed in
+            return
+
+        self.cancel_detection()
+        generation = self.detection_generation
+        # Each run has a cancel event of its own, a cancelled run never affects the next one
+        self.detection_cancel = threading.Event()
+        # The image is already on the canvas, the preview is only needed when it shows the filter output
+        preview = not restore_slices or params.preview_filter_output.get() > 0
+        self.detection_future = self.detection_executor.submit(self.run_detection, params, preview,
+                                                               self.detection_cancel)
+        self.after(50, self.poll_detection, self.detection_future, generation, restore_slices)
+
+    def run_detection(self, params, preview, cancel):
+        # Worker thread: no Tk calls here, the parameters are a snapshot
+        if cancel.is_set():
+            return None
+
+        self.autoslicer.set_params(params)
+        image_path = self.autoslicer.image_path
+        param_values = params.detection_values()
+        bbxs, slices = self.cache.load(image_path, param_values)
+        # Loading hashes the scan on a first visit, which takes a while
+        if cancel.is_set():
+            return None
+
+        if bbxs is None:
+            bbxs, image = self.autoslicer.autodetect_slices(self.set_detection_status, preview, cancel)
+            if cancel.is_set():
+                return None
+            self.cache.store_boxes(image_path, param_values, bbxs)
+        else:
+            image = self.autoslicer.preview_image() if preview else None
+
+        return Image.fromarray(image) if image is not None else None, bbxs, slices, params
+
+    def set_detection_status(self, text):
+        # Called from the worker, picked up by poll_detection
+        self.detection_status = text
+
+    def poll_detection(self, future, generation, restore_slices):
+        if generation != self.detection_generation:
+            return
+
+        if self.detection_status is not None:
+            self.status_text.set(self.detection_status)
+            self.detection_status = None
+
+        if not future.done():
+            self.after(50, self.poll_detection, future, generation, restore_slices)
+            return
+
+        self.detection_future = None
+        try:
+            result = future.result()
+        except Exception as e:
+            self.status_text.set("Detection failed: " + str(e))
+            return
+        if result is not None:
+            self.show_detection(*result, restore_slices=restore_slices)
+
+    def cancel_detection(self, wait_done=False):
+        # Results of the run in flight are discarded, and it stops at the next cancel check
+        self.detection_generation += 1
+        if self.detection_cancel is not None:
+            self.detection_cancel.set()
+            self.detection_cancel = None
+        future = self.detection_future
+        if future is not None and not future.done() and wait_done:
+            wait([future])
+        self.detection_future = None
+
+    def show_detection(self, preview, bbxs, slices, params, new_image=False, restore_slices=False):
+        self.boxes = bbxs
+        # Snapshot of the parameters bbxs were detected with
+        self.boxes_params = params
+        if preview is not None:
+            self.slicing_canvas.set_image(preview, new_image)
+        if restore_slices and slices is not None:
+            # Restore the slices as the user left them
+            self.slicing_canvas.slices = [PhotoSlice(bbox) for bbox, locked in slices]
+            for sl, (bbox, locked) in zip(self.slicing_canvas.slices, slices):
+                sl.toggle_locked(locked)
+            self.slicing_canvas.update_bboxes()
+        else:
+            self.slicing_canvas.update_bboxes(bbxs)
         self.slicing_canvas.update_view()
-        self.update_statusbar("Ready.")
-        self.enable()
+        self.status_text.set("Ready.")
+
+    def detect(self):
+        self.live_detect_after = None
+        try:
+            self.params.values()
+        except tk.TclError:
+            # A spinbox holds a partial value while being typed in
+            return
+
+        self.update_preview()
+        # Neighbours prefetched with the previous parameters are of no use anymore
+        if self.source_index is not None:
+            self.prefetcher.schedule(self.source_images, self.source_index, self.params)
+
+    def on_parameter_changed(self, *args):
+        # Debounced: detection restarts once the value has not changed for a moment
+        if not self.live_detect.get():
+            return
+        if self.live_detect_after is not None:
+            self.after_cancel(self.live_detect_after)
+        self.live_detect_after = self.after(400, self.detect)
+
+    def store_session(self):
+        # Persist the edited slices of the current image so that revisiting it restores them. They are stored with
+        # the parameters their boxes were detected with, nothing is stored while detection is still running.
+        if not self.autoslicer.image_loaded() or self.slicing_canvas.image is None or self.boxes is None:
+            return
+
+        self.cache.store_slices(self.autoslicer.image_path, self.boxes_params.detection_values(),
+                                [(sl.bbox, sl.locked) for sl in self.slicing_canvas.slices])
 
     def set_save_format(self, choice):
         self.save_format = choice
@@ -163,13 +342,22 @@ class PhotoSlicer(DisableableFrame):
             messagebox.showwarning(title="No image loaded", message="Load an image first")
             return
 
+        try:
+            # The slicer holds the parameters of the last detection, the encoder settings may have changed since
+            params = self.params.snapshot()
+        except tk.TclError:
+            messagebox.showwarning(title="Invalid parameter", message="Check the values of the parameters")
+            return
+
         basedir = filedialog.askdirectory(title="Select destination directory")
         if basedir is None or len(basedir) == 0:
             return
 
         self.disable()
+        self.store_session()
 
-        total_saved = 0
+        bboxes = []
+        outnames = []
         for i, slice in enumerate(self.slicing_canvas.slices):
             if not slice.locked:
                 continue
@@ -177,10 +365,13 @@ class PhotoSlicer(DisableableFrame):
             basename = ntpath.basename(self.source_images[self.source_index])
             basename = os.path.splitext(basename)[0] + '_' + f'{i:03}' + '.' + self.save_format
 
-            outname = basedir + os.path.sep + basename
-            self.autoslicer.save_slice(slice.bbox, outname)
-            self.update_statusbar("Saved " + outname)
-            total_saved += 1
+            bboxes.append(slice.bbox)
+            outnames.append(basedir + os.path.sep + basename)
+
+        self.update_statusbar(f"Saving {len(outnames)} slices...")
+        total_saved = len(self.autoslicer.save_slices(bboxes, outnames, params))
+        if total_saved > 0:
+            self.update_statusbar(f"Saved {total_saved} slices to " + basedir)
 
         if total_saved == 0:
             messagebox.showwarning(title="No locked slice to save!",
@@ -195,7 +386,8 @@ class PhotoSlicer(DisableableFrame):
         return
 
     def abort_processing(self):
-        self.autoslicer.abort_operation()
+        self.cancel_detection()
+        self.status_text.set("Detection aborted.")
 
     def add_box(self):
         new_slice = PhotoSlice(None)
@@ -206,13 +398,11 @@ class PhotoSlicer(DisableableFrame):
         if basedir is None:
             basedir = filedialog.askdirectory()
 
-        extensions = ['png', 'jpg', 'jpeg']
-        if basedir is not None:
-            for file in os.listdir(basedir):
-                for e in extensions:
-                    if file.lower().endswith("." + e):
-                        self.source_images.append(os.path.join(basedir, file))
-                        break
+        if basedir:
+            # Reopening a directory adds only the scans not already in the list
+            self.source_images.extend(unique_paths(sorted(discover_images(basedir, recursive=False)),
+                                                   set(os.path.normcase(os.path.abspath(path))
+                                                       for path in self.source_images)))
 
         if len(self.source_images) == 0:
             messagebox.showwarning(title="No images", message="No images available")
@@ -256,6 +446,14 @@ def main():
     if sys.argv[1:]:
         slicer.open_directory(sys.argv[1])
 
+    def on_close():
+        slicer.store_session()
+        slicer.cancel_detection()
+        slicer.detection_executor.shutdown(wait=False)
+        slicer.prefetcher.shutdown()
+        root.destroy()
+
+    root.protocol("WM_DELETE_WINDOW", on_close)
     root.mainloop()
 
 
@@ -1,6 +1,14 @@
+import os
+import copy
+import time
+import threading
 import cv2
 import tkinter as tk
 from tools import *
+from tiledimage import TiledImage, estimated_image_bytes, image_header
+from instrumentation import Instrumentation
+from writer import SliceWriter, ScanSlices
+from filters import box_cascade_blur, fast_adaptive_threshold, downsampled_dilate
 
 
 class Value:
@@ -27,6 +35,9 @@ class Parameter:
     def get(self):
         return self.tk_var.get()
 
+    def set(self, v):
+        self.tk_var.set(v)
+
     def reset(self):
         self.tk_var.set(self.default)
 
@@ -40,15 +51,86 @@ class AutoslicerParams:
         self.bbox_min_size_prop = Parameter(2, 0, 100, 1, "Detectable min surface (% total)")
         self.bbox_fill_thresh = Parameter(10, 0, 100, 1, "Bounding box fill ratio threshold")
         self.dilate_kernel = Parameter(16, 0, 500, 1, "Dilate kernel size (0=disabled)")
+        self.blur_engine = Parameter(0, 0, 1, 1, "Blur engine (0=exact, 1=fast box cascade)")
+        self.threshold_engine = Parameter(0, 0, 1, 1, "Gauss thresh engine (0=exact, 1=fast box cascade)")
+        self.dilate_engine = Parameter(0, 0, 1, 1, "Dilate engine (0=exact, 1=fast downsampled)")
+        self.detect_scale = Parameter(100, 5, 100, 5, "Detection resolution (% full)")
+        self.refine_edges = Parameter(0, 0, 1, 1, "Refine edges at full resolution")
         self.preview_filter_output = Parameter(0, 0, 1, 1, "Preview filter output")
+        self.jpeg_quality = Parameter(95, 0, 100, 1, "JPEG quality")
+        self.jpeg_progressive = Parameter(0, 0, 1, 1, "Progressive JPEG")
+        self.png_compression = Parameter(3, 0, 9, 1, "PNG compression level (0=fastest)")
+        self.webp_quality = Parameter(90, 1, 101, 1, "WebP quality (101=lossless)")
+
+    # Settings of the output encoders, which do not affect detection
+    ENCODER_PARAMS = ("jpeg_quality", "jpeg_progressive", "png_compression", "webp_quality")
+
+    def values(self):
+        return {pi: getattr(self, pi).get() for pi in self.__dict__}
+
+    # Values that affect the detected boxes, display-only settings excluded
+    def detection_values(self):
+        values = self.values()
+        values.pop("preview_filter_output")
+        for pi in self.ENCODER_PARAMS:
+            values.pop(pi)
+        return values
+
+    # cv2.imwrite / cv2.imencode flags for a file name or extension
+    def encode_params(self, out_path):
+        ext = os.path.splitext(out_path)[1].lower() or "." + out_path.lower()
+        if ext in (".jpg", ".jpeg"):
+            return [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality.get(),
+                    cv2.IMWRITE_JPEG_PROGRESSIVE, self.jpeg_progressive.get()]
+        if ext == ".png":
+            return [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression.get()]
+        if ext == ".webp":
+            return [cv2.IMWRITE_WEBP_QUALITY, self.webp_quality.get()]
+        return []
+
+    def set_values(self, values):
+        for pi, v in values.items():
+            getattr(self, pi).set(v)
+
+    # Detached copy of the current values, safe to read from other threads (Tk variables are not)
+    def snapshot(self):
+        params = copy.copy(self)
+        for pi in self.__dict__:
+            p = copy.copy(getattr(self, pi))
+            p.tk_var = Value(p.get())
+            p.control = None
+            setattr(params, pi, p)
+        return params
+
+
+def cancelled(cancel):
+    return cancel is not None and cancel.is_set()
 
 
 class Autoslicer:
+    # JPEG decoders scale by these factors while decoding, at a fraction of the cost of a full decode
+    REDUCED_GRAYSCALE = {2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                         8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+
     def __init__(self, params=None):
-        self.image = None
+        self._image = None
+        self.image_shape = None
+        self.color_source = None
+        self.gray_source = None
+        self.full_gray = None
+        self.decode_lock = threading.Lock()
         self.image_gray = None
-        self.abort_flag = False
+        self.gray_scale = 1.0
+        self.image_path = None
+        # Stage outputs are kept for the next detection of the same scan only when cache_stages is set: they hold
+        # several full resolution images, worth their memory when parameters are tuned but not in a batch
+        self.cache_stages = False
+        self.stage_cache = {}
         self.params = None
+        self.export_workers = None
+        self.status_interval = 0.1
+        self.memory_budget_mb = 0
+        self.instrumentation = Instrumentation()
         self.set_params(params)
 
     def set_params(self, params):
@@ -57,137 +139,465 @@ class Autoslicer:
         else:
             self.params = AutoslicerParams()
 
-    def image_loaded(self):
-        return self.image is not None
+    # The colour image. Scans from load_image are decoded in colour only here, the first time the colour pixels
+    # are needed for export or display: detection runs on image_gray, and scans without photos never get here.
+    @property
+    def image(self):
+        if self._image is None and self.color_source is not None:
+            with self.decode_lock:
+                if self._image is None:
+                    with self.instrumentation.stage("decode", scan=self.image_path):
+                        image = cv2.imread(self.color_source)
+                    if image is None:
+                        raise IOError("Cannot read " + self.color_source)
+                    self._image = image
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        self._image = image
+        self.color_source = None
+        self.image_shape = image.shape if image is not None else None
 
-    def load_image(self, image_path):
-        print(image_path)
-        self.image = cv2.imread(image_path)
-        self.image_gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+    def image_loaded(self):
+        return self._image is not None or self.color_source is not None
 
-    def abort_operation(self):
-        self.abort_flag = True
+    def image_tiled(self):
+        return isinstance(self._image, TiledImage)
 
-    # Find all bbox related to n
-    def get_box_relatives(self, hierarchy, n):
-        relatives = []
+    def unload_image(self, image_path=None):
+        self.image_path = image_path
+        self.stage_cache = {}
+        if isinstance(self._image, TiledImage):
+            self._image.close()
+        self.image = None
+        self.gray_source = None
+        self.full_gray = None
+        self.image_gray = None
 
-        while 1:
-            father = hierarchy[n][3]
-            if father >= 0:
-                relatives.append(father)
-                n = father
+    # color decodes the scan in colour right away and derives the grayscale image from it: one decode instead of two
+    # when its slices are going to be exported anyway, as in batches. Otherwise only a grayscale image, reduced if
+    # the detection resolution allows, is decoded until the colour pixels are needed: faster when only the boxes
+    # or a preview are, or when the scan has no photos.
+    def load_image(self, image_path, color=False):
+        print(image_path)
+        self.unload_image(image_path)
+
+        with self.instrumentation.stage("load", scan=image_path) as event:
+            budget = self.memory_budget_mb * 2 ** 20
+            if budget > 0 and estimated_image_bytes(image_path) > budget:
+                # Too large for the budget: map the scan and detect on a decimated grayscale stream instead
+                self.image = TiledImage.open(image_path)
+                h, w = self.image.shape[:2]
+                factor = max(int(np.ceil(np.sqrt(h * w / (budget / 8)))), 1)
+                self.image_gray = self.image.reduced_gray(factor, budget // 8)
+                self.gray_scale = 1 / factor
+            elif color:
+                image = cv2.imread(image_path)
+                if image is None:
+                    raise IOError("Cannot read " + image_path)
+                self.image = image
+                self.image_gray = self.full_gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+                self.gray_scale = 1.0
             else:
-                return relatives
-
-    def autodetect_slices(self, update_status_callback=None):
-        filter_out = self.image_gray
-        self.abort_flag = False
-
-        # Gaussian blur
+                # Grayscale only for now, the colour image is decoded when first used
+                self.color_source = image_path
+                self.load_gray(min(self.params.detect_scale.get() / 100, 1.0))
+
+            event["height"], event["width"] = self.image_shape[:2]
+            event["tiled"] = isinstance(self._image, TiledImage)
+            event["gray_scale"] = self.gray_scale
+
+    # Decodes the grayscale scan from its file at no less than the given scale: JPEGs by the largest reduction
+    # the decoder supports that still suffices, other formats always at full resolution
+    def load_gray(self, scale):
+        factor = 1
+        try:
+            image_format, w, h = image_header(self.color_source)
+            if image_format == "JPEG":
+                factor = max((f for f in self.REDUCED_GRAYSCALE if f * scale <= 1), default=1)
+                self.image_shape = (h, w, 3)
+        except (OSError, ValueError):
+            # Not readable by PIL, OpenCV may still manage
+            pass
+
+        gray = cv2.imread(self.color_source, self.REDUCED_GRAYSCALE[factor] if factor > 1 else cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            raise IOError("Cannot read " + self.color_source)
+        if factor == 1:
+            # Exact size, whatever the header said
+            self.image_shape = gray.shape[:2] + (3,)
+            self.full_gray = gray
+
+        self.image_gray = gray
+        self.gray_scale = gray.shape[1] / self.image_shape[1]
+        self.gray_source = self.color_source
+        self.stage_cache = {}
+
+    # In memory counterparts of load_image: a BGR, BGRA or grayscale ndarray, or an encoded image in a bytes like
+    # buffer. name only labels the scan in instrumentation events. The array is used as is, not copied.
+    def load_array(self, image, name=None):
+        self.unload_image(name)
+        with self.instrumentation.stage("load", scan=name) as event:
+            if image.ndim == 2:
+                self.image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+                self.image_gray = image
+            else:
+                self.image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR) if image.shape[2] == 4 else image
+                self.image_gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
+            self.gray_scale = 1.0
+            event["height"], event["width"] = self.image.shape[:2]
+            event["tiled"] = False
+
+    def load_bytes(self, data, name=None):
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise IOError("Cannot decode " + (name or "image buffer"))
+        self.load_array(image, name)
+
+    # Takes over the image another slicer loaded, e.g. on a background thread. A colour image it has not decoded
+    # yet stays undecoded.
+    def adopt_image(self, other):
+        if isinstance(self._image, TiledImage) and self._image is not other._image:
+            self._image.close()
+        self.image_path = other.image_path
+        self._image = other._image
+        self.image_shape = other.image_shape
+        self.color_source = other.color_source
+        self.gray_source = other.gray_source
+        self.full_gray = other.full_gray
+        self.image_gray = other.image_gray
+        self.gray_scale = other.gray_scale
+        self.stage_cache = {}
+
+    # Full resolution grayscale pixels of a region, also when image_gray is decimated
+    def gray_region(self, x1, y1, x2, y2):
+        if self.gray_scale == 1:
+            return self.image_gray[y1:y2, x1:x2]
+        if isinstance(self._image, TiledImage):
+            return self._image.gray((slice(y1, y2), slice(x1, x2)))
+        if self.full_gray is None:
+            with self.decode_lock:
+                if self.full_gray is None:
+                    self.full_gray = cv2.imread(self.gray_source, cv2.IMREAD_GRAYSCALE)
+        return self.full_gray[y1:y2, x1:x2]
+
+    # Odd kernel size for a parameter expressed at full resolution, scaled to the detection resolution
+    def scaled_block(self, size, scale, minimum=1):
+        block = max(int(round(size * scale)), minimum)
+        if block % 2 == 0:
+            block += 1
+        return block
+
+    # Parameters each filter stage depends on; a stage is recomputed only when these or its input change
+    def blur_key(self, scale):
+        return self.params.gaussian.get(), self.params.blur_engine.get(), scale
+
+    def threshold_key(self, scale):
+        method = self.params.bw_method.get()
+        if method == 0:
+            return method, self.params.bw_thresh.get()
+        if method == 1:
+            return method, self.params.bw_gauss.get(), self.params.threshold_engine.get(), scale
+        return method,
+
+    def dilate_key(self, scale):
+        return self.params.dilate_kernel.get(), self.params.dilate_engine.get(), scale
+
+    def filter_key(self):
+        return self.params.bbox_min_size_prop.get(), self.params.bbox_fill_thresh.get()
+
+    def downscale(self, gray, scale):
+        if scale < 1:
+            return cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return gray
+
+    def blur(self, gray, scale=1.0):
         if self.params.gaussian.get() > 0:
-            update_status_callback("Gaussian blur...")
+            block = self.scaled_block(self.params.gaussian.get(), scale)
+            if self.params.blur_engine.get() > 0:
+                return box_cascade_blur(gray, block)
+            return cv2.GaussianBlur(gray, (block, block), 0)
+        return gray
 
-            if self.params.gaussian.get() % 2 == 0:
-                block = self.params.gaussian.get() + 1
-            else:
-                block = self.params.gaussian.get()
-            filter_out = cv2.GaussianBlur(filter_out, (block, block), 0)
+    # Returns the threshold that was applied and the binary image
+    def threshold(self, gray, scale=1.0, otsu_thresh=None):
+        bw_thresh = self.params.bw_thresh.get()
 
         # Binary filter
         if self.params.bw_method.get() == 0:
-            update_status_callback("Simple binary thresholding...")
-            ret, filter_out = cv2.threshold(filter_out, self.params.bw_thresh.get(), 255, cv2.THRESH_BINARY)
+            return cv2.threshold(gray, bw_thresh, 255, cv2.THRESH_BINARY)
 
         # Adaptive thresh
         if self.params.bw_method.get() == 1:
-            update_status_callback("Adaptive Gaussian thresholding...")
-            if self.params.bw_gauss.get() % 2 == 0:
-                block = self.params.bw_gauss.get() + 1
-            else:
-                block = self.params.bw_gauss.get()
-            filter_out = cv2.adaptiveThreshold(filter_out, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
-                                               block, 2)
+            block = self.scaled_block(self.params.bw_gauss.get(), scale, 3)
+            if self.params.threshold_engine.get() > 0:
+                return bw_thresh, fast_adaptive_threshold(gray, block, 2)
+            return bw_thresh, cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+                                                    block, 2)
 
         # Otsu thresh
-        if self.params.bw_method.get() == 2:
-            update_status_callback("Otsu thresholding...")
-            ret, filter_out = cv2.threshold(filter_out, self.params.bw_thresh.get(), 255,
-                                            cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        if otsu_thresh is None:
+            return cv2.threshold(gray, bw_thresh, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        return cv2.threshold(gray, otsu_thresh, 255, cv2.THRESH_BINARY)
 
-        # Dilate
+    def dilate(self, binary, scale=1.0):
         if self.params.dilate_kernel.get() > 0:
-            update_status_callback("Dilate...")
-            kernel = np.ones((self.params.dilate_kernel.get(), self.params.dilate_kernel.get()), np.uint8)
-            filter_out = cv2.dilate(filter_out, kernel)
-
-        # Find contours
-        update_status_callback("Finding contours...")
-        contours, hierarchy = cv2.findContours(filter_out, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-
-        if hierarchy is not None:
-            hierarchy = hierarchy[0]
+            size = max(int(round(self.params.dilate_kernel.get() * scale)), 1)
+            if self.params.dilate_engine.get() > 0:
+                return downsampled_dilate(binary, size)
+            kernel = np.ones((size, size), np.uint8)
+            return cv2.dilate(binary, kernel)
+        return binary
+
+    # Blur, threshold and dilate without going through the stage cache
+    def filter_image(self, gray, scale=1.0, otsu_thresh=None):
+        bw_thresh, filter_out = self.threshold(self.blur(gray, scale), scale, otsu_thresh)
+        return self.dilate(filter_out, scale), bw_thresh
+
+    # Returns the cached output of a stage if it was computed with the same key, otherwise computes it and caches it
+    # if cache_stages is set
+    def cached_stage(self, name, key, compute, update_status_callback=None, status=None):
+        cached = self.stage_cache.get(name)
+        if cached is not None and cached[0] == key:
+            self.instrumentation.cached_stage(name, scan=self.image_path)
+            return cached[1]
+
+        if update_status_callback is not None and status is not None:
+            update_status_callback(status)
+        with self.instrumentation.stage(name, scan=self.image_path) as event:
+            result = compute()
+            if isinstance(result, np.ndarray):
+                event["height"], event["width"] = result.shape[:2]
+        if self.cache_stages:
+            self.stage_cache[name] = (key, result)
+        return result
+
+    # Re-fit a box found at reduced resolution using the full resolution pixels around it
+    def refine_slice(self, bbox, scale, bw_thresh):
+        margin = int(np.ceil(2 / scale)) + self.params.dilate_kernel.get() + self.params.gaussian.get()
+        x, y, w, h = cv2.boundingRect(bbox)
+        x1, y1 = max(x - margin, 0), max(y - margin, 0)
+        x2, y2 = min(x + w + margin, self.image_shape[1]), min(y + h + margin, self.image_shape[0])
+
+        # Otsu picked its threshold on the whole scan, the ROI reuses it
+        roi_out, _ = self.filter_image(self.gray_region(x1, y1, x2, y2), otsu_thresh=bw_thresh)
+        contours, _ = cv2.findContours(roi_out, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+
+        coarse_center, coarse_size, _ = cv2.minAreaRect(bbox)
+        coarse_center = (coarse_center[0] - x1, coarse_center[1] - y1)
+        coarse_area = coarse_size[0] * coarse_size[1]
+
+        # Pick the contour around the coarse center whose bounding box area is closest to the coarse one
+        best = None
+        best_ratio = 1.25
+        for contour in contours:
+            if len(contour) < 4 or cv2.pointPolygonTest(contour, coarse_center, False) < 0:
+                continue
+            rect = cv2.minAreaRect(contour)
+            area = rect[1][0] * rect[1][1]
+            if area <= 0:
+                continue
+            ratio = max(area / coarse_area, coarse_area / area)
+            if ratio < best_ratio:
+                best, best_ratio = rect, ratio
+
+        if best is None:
+            return bbox
+
+        box = cv2.boxPoints(best)
+        box[:, 0] += x1
+        box[:, 1] += y1
+        return np.intp(np.round(box))
+
+    # cancel, a threading.Event of this run only, stops the detection once set: no slices are returned then
+    def autodetect_slices(self, update_status_callback=None, preview=True, cancel=None):
+        if update_status_callback is None:
+            update_status_callback = lambda text: None
+
+        h, w = self.image_shape[:2]
+        with self.instrumentation.stage("detect", scan=self.image_path, width=w, height=h) as event:
+            boxes, filter_out = self.detect_slices(update_status_callback, cancel)
+            event["slices"] = len(boxes)
+            event["aborted"] = cancelled(cancel)
+
+        # The RGB preview is a full copy of the scan, callers that only need the boxes skip it
+        return boxes, self.preview_image(filter_out) if preview else None
+
+    def detect_slices(self, update_status_callback, cancel=None):
+
+        # Detection runs on a decimated copy, kernel sizes are scaled to match.
+        # image_gray may already be decimated (tiled loading, reduced decode), it is never upsampled; a reduced
+        # decode is redone finer if the detection resolution was raised since.
+        scale = min(self.params.detect_scale.get() / 100, 1.0)
+        if self.gray_source is not None and scale > self.gray_scale * 1.001 and self.full_gray is None:
+            self.load_gray(scale)
+        gray_resize = min(scale / self.gray_scale, 1.0)
+        scale = gray_resize * self.gray_scale
+
+        # Each stage key includes the key of the stage before it, so a change invalidates everything downstream
+        key = (scale,)
+        detect_gray = self.cached_stage("downscale", key, lambda: self.downscale(self.image_gray, gray_resize),
+                                        update_status_callback, "Downscaling..." if gray_resize < 1 else None)
+
+        key += self.blur_key(scale)
+        blurred = self.cached_stage("blur", key, lambda: self.blur(detect_gray, scale),
+                                    update_status_callback, "Gaussian blur...")
+        # A cancel is honoured between stages, the OpenCV calls themselves cannot be interrupted
+        if cancelled(cancel):
+            return [], blurred
+
+        key += self.threshold_key(scale)
+        bw_thresh, thresholded = self.cached_stage("threshold", key, lambda: self.threshold(blurred, scale),
+                                                   update_status_callback, "Thresholding...")
+
+        key += self.dilate_key(scale)
+        filter_out = self.cached_stage("dilate", key, lambda: self.dilate(thresholded, scale),
+                                       update_status_callback, "Dilate...")
+        if cancelled(cancel):
+            return [], filter_out
+
+        contours, hierarchy = self.cached_stage(
+            "contours", key, lambda: cv2.findContours(filter_out, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE),
+            update_status_callback, "Finding contours...")
+
+        if hierarchy is None:
+            return [], filter_out
+
+        key += self.filter_key()
+        cached = self.stage_cache.get("filter")
+        if cached is not None and cached[0] == key:
+            self.instrumentation.cached_stage("filter", scan=self.image_path)
+            boxes = cached[1]
         else:
-            if self.params.preview_filter_output.get() > 0:
-                return [], cv2.cvtColor(filter_out, cv2.COLOR_GRAY2RGB)
-            else:
-                return [], cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB)
-
-        # Calculate total image area and minimum box thresh
-        h, w, channels = self.image.shape
+            with self.instrumentation.stage("filter", scan=self.image_path, contours=len(contours)) as event:
+                boxes = self.filter_contours(contours, hierarchy[0], filter_out.shape[:2], update_status_callback,
+                                             event, cancel)
+                event["accepted"] = len(boxes)
+                event["rejected"] = len(contours) - len(boxes)
+            if cancelled(cancel):
+                return [], filter_out
+            if self.cache_stages:
+                self.stage_cache["filter"] = (key, boxes)
+
+        # Back to full resolution coordinates
+        if scale < 1:
+            key += (self.params.refine_edges.get(),)
+            boxes = self.cached_stage("refine", key, lambda: self.rescale_slices(boxes, scale, bw_thresh),
+                                      update_status_callback, "Refining edges...")
+
+        return boxes, filter_out
+
+    def rescale_slices(self, boxes, scale, bw_thresh):
+        boxes = [np.intp(np.round(box / scale)) for box in boxes]
+        if self.params.refine_edges.get() > 0:
+            boxes = [self.refine_slice(box, scale, bw_thresh) for box in boxes]
+        return boxes
+
+    def filter_contours(self, contours, hierarchy, shape, update_status_callback, event=None, cancel=None):
+        # Calculate total image area and minimum box thresh, at detection resolution
+        h, w = shape
         img_area = h * w
         min_area = self.params.bbox_min_size_prop.get() / 100 * img_area
+        fill_thresh = self.params.bbox_fill_thresh.get()
 
         boxes = []
-        good_ids = []
-        discarded_ids = []
-        for n, contour in enumerate(contours):
-
-            if self.abort_flag:
+        if len(contours) == 0:
+            return boxes
+
+        # Vectorized pass over the points of all contours: extent and area of each contour
+        lengths = np.fromiter(map(len, contours), dtype=np.int64, count=len(contours))
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        pts = np.concatenate(contours).reshape(-1, 2).astype(np.float64)
+        x, y = pts[:, 0], pts[:, 1]
+
+        x_extent = np.maximum.reduceat(x, starts) - np.minimum.reduceat(x, starts)
+        y_extent = np.maximum.reduceat(y, starts) - np.minimum.reduceat(y, starts)
+
+        # Shoelace formula, the same area cv2.contourArea returns
+        following = np.arange(1, len(pts) + 1)
+        following[starts + lengths - 1] = starts
+        shape_areas = np.abs(np.add.reduceat(x * y[following] - x[following] * y, starts)) / 2
+
+        # The rotated bbox is never larger than the axis aligned one (plus rounding of its corners), and
+        # a good contour fills at least fill_thresh of a bbox of at least min_area
+        candidates = np.flatnonzero((lengths >= 4) & (shape_areas >= 1) &
+                                    ((x_extent + 2) * (y_extent + 2) >= min_area) &
+                                    (shape_areas >= fill_thresh / 100 * min_area * 0.999))
+        if event is not None:
+            event["candidates"] = len(candidates)
+
+        # Contours come parent first, so a walk up the tree only meets contours already decided.
+        # Whether a contour has an accepted ancestor is memoized, making the check O(1) amortized.
+        parents = hierarchy[:, 3].tolist()
+        accepted = set()
+        inside = {}
+
+        def inside_accepted(n):
+            chain = []
+            parent = parents[n]
+            result = False
+            while parent >= 0:
+                if parent in accepted:
+                    result = True
+                    break
+                if parent in inside:
+                    result = inside[parent]
+                    break
+                chain.append(parent)
+                parent = parents[parent]
+            for c in chain:
+                inside[c] = result
+            return result
+
+        next_status = 0
+        for i, n in enumerate(candidates.tolist()):
+
+            if cancelled(cancel):
                 boxes = []
                 break
 
-            # No triangles
-            if len(contour) < 4:
-                discarded_ids.append(n)
-                continue
-
-            update_status_callback("Processing contour " + str(n) + "/" + str(len(contours)))
+            # Throttled, progress reporting may redraw the UI
+            now = time.monotonic()
+            if now >= next_status:
+                update_status_callback("Processing contour " + str(i) + "/" + str(len(candidates)))
+                next_status = now + self.status_interval
 
             # If child of a selected bbox, then it's discarded (it's inside)
-            relatives = self.get_box_relatives(hierarchy, n)
-            if set(relatives).intersection(good_ids):
-                discarded_ids.append(n)
+            if inside_accepted(n):
                 continue
 
             # Find bounding box
-            bbox_rot_rect = cv2.minAreaRect(contour)
-            bounding_box = cv2.boxPoints(bbox_rot_rect)
-            bounding_box = np.int0(bounding_box)
-            shape_area = cv2.contourArea(contour)
+            bounding_box = np.intp(cv2.boxPoints(cv2.minAreaRect(contours[n])))
+            shape_area = shape_areas[n]
             bbox_area = cv2.contourArea(bounding_box)
 
-            # Too small or too big
-            if shape_area < 1 or bbox_area < min_area or bbox_area > img_area * 0.90:
-                discarded_ids.append(n)
+            # Degenerate (a line or a point, min_area may be 0), too small or too big
+            if bbox_area <= 0 or bbox_area < min_area or bbox_area > img_area * 0.90:
                 continue
 
             # Fill ratio
-            fill_ratio = (bbox_area - (bbox_area - shape_area)) / bbox_area * 100
-            if fill_ratio < self.params.bbox_fill_thresh.get():
-                discarded_ids.append(n)
+            fill_ratio = shape_area / bbox_area * 100
+            if fill_ratio < fill_thresh:
                 continue
 
             # It's good
-            good_ids.append(n)
+            accepted.add(n)
             boxes.append(bounding_box)
 
-        if self.params.preview_filter_output.get() > 0:
-            return boxes, cv2.cvtColor(filter_out, cv2.COLOR_GRAY2RGB)
+        return boxes
+
+    def preview_image(self, filter_out=None):
+        if filter_out is not None and self.params.preview_filter_output.get() > 0:
+            if filter_out.shape[:2] != self.image_shape[:2]:
+                filter_out = cv2.resize(filter_out, (self.image_shape[1], self.image_shape[0]),
+                                        interpolation=cv2.INTER_NEAREST)
+            return cv2.cvtColor(filter_out, cv2.COLOR_GRAY2RGB)
         else:
-            return boxes, cv2.cvtColor(self.image, cv2.COLOR_BGR2RGB)
+            return cv2.cvtColor(self.image[:, :], cv2.COLOR_BGR2RGB)
 
-    def save_slice(self, hull_quad, out_path):
+    def slice_transform(self, hull_quad):
+        hull_quad = np.float32(hull_quad).reshape(4, 2)
 
         # Get bounding rotated rectangle containing the simplified hull
         hull_quad_rbb = cv2.minAreaRect(hull_quad)
@@ -197,45 +607,11 @@ class Autoslicer:
         # orientation_offset is used later to straighten the image using the top left corner provided by slice
         hull_quad_rbb_pts, orientation_offset = shift_points_to_min_distance(hull_quad_rbb_pts, hull_quad)
 
-        # For debugging
-        # cv2.drawContours(self.image, [np.int0(hull_quad_rbb_pts)], -1, (0, 0, 255), 1)
-        # cv2.circle(self.image, tuple(hull_quad_rbb_pts[0]), 10, (0, 0, 255), 2)
-        # cv2.drawContours(self.image, [np.int0(hull_quad)], -1, (0, 255, 0), 1)
-        # cv2.circle(self.image, tuple(hull_quad[0]), 20, (0, 255, 0), 2)
-
-        # Get the circle enclosing the bounding box enclosing the hull
-        hull_quad_rbb_ecirc_c, hull_quad_rbb_ecirc_r = cv2.minEnclosingCircle(hull_quad_rbb_pts)
-        hull_quad_rbb_ecirc_c = tuple(map(int, hull_quad_rbb_ecirc_c))
-        hull_quad_rbb_ecirc_r = int(hull_quad_rbb_ecirc_r)
-        hull_quad_rbb_topleft_pt = \
-            (int(hull_quad_rbb_ecirc_c[0] - hull_quad_rbb_ecirc_r),
-             int(hull_quad_rbb_ecirc_c[1] - hull_quad_rbb_ecirc_r))
-
-        # For debugging
-        # cv2.circle(self.image, hull_quad_rbb_ecirc_c, hull_quad_rbb_ecirc_r, (0, 255, 0), 5)
-        # cv2.circle(self.image, hull_quad_rbb_ecirc_c, 10, (0, 255, 0), 2)
-        # cv2.circle(self.image, hull_quad_rbb_topleft_pt, 10, (255, 255, 0), 2)
-
-        # Crop to circle
-        hull_quad_img = crop_to_circle(self.image, hull_quad_rbb_ecirc_c, hull_quad_rbb_ecirc_r)
-
-        # Calculate offset array and apply offset to hull, hull bbox and hull bbox enclosing circle center
-        offset_a = np.array(hull_quad_rbb_topleft_pt)
-        for i in range(0, 3):
-            offset_a = np.append(offset_a, hull_quad_rbb_topleft_pt)
-        offset_a = offset_a.reshape(4, 2)
-        hull_quad = hull_quad - offset_a
-        hull_quad_rbb_pts = hull_quad_rbb_pts - offset_a
-        hull_quad_rbb_ecirc_c = tuple(map(lambda ki, kj: ki - kj, hull_quad_rbb_ecirc_c, hull_quad_rbb_topleft_pt))
-
-        # Homography for perspective adjust
+        # Homography for perspective adjust, in source image coordinates
         hg_perspective_adj, _ = cv2.findHomography(hull_quad, hull_quad_rbb_pts)
-        hull_quad_img_h, hull_quad_img_w = hull_quad_img.shape[:2]
-        warped_img = cv2.warpPerspective(hull_quad_img, hg_perspective_adj, (hull_quad_img_h, hull_quad_img_w),
-                                         flags=cv2.INTER_CUBIC)
 
-        # Get hull rotated bounding box size and angle; center is taken from enclosing circle
-        _, hull_quad_rbb_s, hull_quad_rbb_a = hull_quad_rbb
+        # Get hull rotated bounding box center, size and angle
+        hull_quad_rbb_c, hull_quad_rbb_s, hull_quad_rbb_a = hull_quad_rbb
         hull_quad_rbb_s = tuple(map(int, hull_quad_rbb_s))
 
         # Use top left corner orientation provided by slice
@@ -243,14 +619,69 @@ class Autoslicer:
         if orientation_offset == 0 or orientation_offset == 2:  # swap width with height
             hull_quad_rbb_s = (hull_quad_rbb_s[1], hull_quad_rbb_s[0])
 
-        # Get rotation matrix from rectangle
-        hull_quad_rot_matrix = cv2.getRotationMatrix2D(hull_quad_rbb_ecirc_c, rot, 1)
+        # Rotation around the bbox center, then a crop of the bbox size centered on it
+        hull_quad_rot_matrix = np.vstack([cv2.getRotationMatrix2D(hull_quad_rbb_c, rot, 1), [0, 0, 1]])
+        crop_matrix = translation_matrix((hull_quad_rbb_s[0] - 1) / 2 - hull_quad_rbb_c[0],
+                                         (hull_quad_rbb_s[1] - 1) / 2 - hull_quad_rbb_c[1])
+
+        # Perspective adjust, rotation and crop composed into one source to slice mapping
+        return crop_matrix @ hull_quad_rot_matrix @ hg_perspective_adj, hull_quad_rbb_s
+
+    def render_slice(self, hull_quad, dst=None, image=None, scan=None):
+        # image and scan default to the current scan, given they let a writer render slices of a scan left since
+        image, scan = (image, scan) if image is not None else (self.image, self.image_path)
+        transform, size = self.slice_transform(hull_quad)
+        with self.instrumentation.stage("warp", scan=scan, width=size[0], height=size[1]):
+            return warp_roi(image, transform, size, cv2.INTER_CUBIC, dst=dst)
+
+    def iter_slices(self, hull_quads, reuse_buffer=True):
+        # Yields the slices as ndarrays, nothing goes through the disk. With reuse_buffer every slice is a view of
+        # one buffer sized for the largest, so a slice is only valid until the next one is requested: copy the ones
+        # to keep. Without, each slice is a new array.
+        transforms = [self.slice_transform(hull_quad) for hull_quad in hull_quads]
+        if len(transforms) == 0:
+            return
+
+        channels = self.image.shape[2:]
+        buffer = None
+        if reuse_buffer:
+            largest = max(w * h for _, (w, h) in transforms)
+            buffer = np.empty(largest * int(np.prod(channels)), self.image.dtype)
+
+        for transform, (w, h) in transforms:
+            dst = buffer[:w * h * int(np.prod(channels))].reshape((h, w) + channels) if buffer is not None else None
+            with self.instrumentation.stage("warp", scan=self.image_path, width=w, height=h):
+                slice_img = warp_roi(self.image, transform, (w, h), cv2.INTER_CUBIC, dst=dst)
+            yield slice_img
 
-        # Perform rotation on src image
-        warped_rotated_img = cv2.warpAffine(warped_img, hull_quad_rot_matrix, warped_img.shape[:2],
-                                            flags=cv2.INTER_CUBIC)
-
-        # Crop based on size of bbox and center of enclosing circle
-        warped_rotated_cropped_img = cv2.getRectSubPix(warped_rotated_img, hull_quad_rbb_s, hull_quad_rbb_ecirc_c)
-
-        cv2.imwrite(out_path, warped_rotated_cropped_img)
+    def save_slice(self, hull_quad, out_path):
+        return self.save_slices([hull_quad], [out_path])
+
+    # Output stage for the slices of this slicer, one may serve every scan of a batch
+    def slice_writer(self, max_workers=None):
+        workers = self.export_workers if self.export_workers is not None else os.cpu_count() or 1
+        if max_workers is not None:
+            workers = min(workers, max_workers)
+        return SliceWriter(max(workers, 1), instrumentation=self.instrumentation)
+
+    def queue_slices(self, hull_quads, out_paths, writer, params=None):
+        # Puts the slices on writer, to be warped, encoded and written by its threads, and returns their ScanSlices.
+        # The next scan may be loaded before they are written, unless the image is tiled: it is read from its file,
+        # which loading the next scan closes.
+        # The encoder settings come from params if given, otherwise from the parameters of the last detection.
+        params = params if params is not None else self.params
+        slices = ScanSlices(self.image_path)
+        # Scans loaded grayscale first are decoded in colour here, unless they have no photos
+        image = self.image if len(hull_quads) > 0 else None
+        for hull_quad, out_path in zip(hull_quads, out_paths):
+            writer.put(lambda hull_quad=hull_quad: self.render_slice(hull_quad, image=image, scan=slices.scan),
+                       out_path, params.encode_params(out_path), slices)
+        return slices
+
+    def save_slices(self, hull_quads, out_paths, params=None):
+        # Slices are written several at a time, by a writer of their own; returns their paths once written
+        if len(hull_quads) == 0:
+            return []
+        with self.slice_writer(len(hull_quads)) as writer:
+            slices = self.queue_slices(hull_quads, out_paths, writer, params)
+        return slices.result()
@@ -0,0 +1,271 @@
+import os
+import time
+import queue
+import multiprocessing
+import cv2
+from autoslicer import Autoslicer, AutoslicerParams
+from instrumentation import Instrumentation, MemorySink
+from workqueue import LeaseKeeper, default_worker_id
+
+
+class BatchResult:
+    def __init__(self, image_file, outputs=None, error=None, events=None):
+        self.image_file = image_file
+        self.outputs = outputs if outputs is not None else []
+        self.error = error
+        self.events = events if events is not None else []
+
+    def ok(self):
+        return self.error is None
+
+
+def slice_output_path(output_dir, image_file, i, output_format=None):
+    # Slices keep the format of the scan unless output_format, e.g. "webp", is given
+    base, ext = os.path.splitext(os.path.basename(image_file))
+    if output_format is not None:
+        ext = "." + output_format.lstrip(".")
+    return os.path.join(output_dir, base + f"_{i}" + ext)
+
+
+def scan_output_dir(output_dir, image_file, input_root=None):
+    # With input_root, slices go to the subdirectory of output_dir mirroring the one of the scan under input_root,
+    # so scans with the same name in different directories do not overwrite each other's slices
+    if input_root is None:
+        return output_dir
+    rel_dir = os.path.relpath(os.path.dirname(os.path.abspath(image_file)), os.path.abspath(input_root))
+    if rel_dir == os.curdir or rel_dir.startswith(os.pardir):
+        return output_dir
+    out_dir = os.path.join(output_dir, rel_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    return out_dir
+
+
+def no_status(text):
+    pass
+
+
+def process_image(slicer, image_file, output_dir, update_status_callback=no_status, input_root=None,
+                  output_format=None, writer=None):
+    # Returns the ScanSlices of the scan. With writer, e.g. one for the whole batch, they may still be being written
+    # when it returns, while the next scan is loaded; without, they are written by a writer of their own.
+    output_dir = scan_output_dir(output_dir, image_file, input_root)
+    # The slices are exported right after, the colour image is needed anyway
+    slicer.load_image(image_file, color=True)
+    bboxes, _ = slicer.autodetect_slices(update_status_callback, preview=False)
+    out_paths = [slice_output_path(output_dir, image_file, i_slice, output_format) for i_slice in range(len(bboxes))]
+    if writer is None:
+        with slicer.slice_writer(len(bboxes)) as writer:
+            return slicer.queue_slices(bboxes, out_paths, writer)
+
+    slices = slicer.queue_slices(bboxes, out_paths, writer)
+    if slicer.image_tiled():
+        slices.join()
+    return slices
+
+
+class PendingResult:
+    # A scan processed by start_image, whose slices may still be being written: result() waits for them
+
+    def __init__(self, slicer, image_file, started, slices=None, error=None):
+        self.slicer = slicer
+        self.image_file = image_file
+        self.started = started
+        self.slices = slices
+        self.error = error
+
+    def result(self):
+        outputs, error = [], self.error
+        if error is None:
+            try:
+                outputs = self.slices.result()
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+        result = BatchResult(self.image_file, outputs, error)
+
+        instrumentation = self.slicer.instrumentation
+        if instrumentation.enabled():
+            instrumentation.emit({"type": "scan", "scan": self.image_file,
+                                  "duration_s": time.perf_counter() - self.started, "slices": len(result.outputs),
+                                  "error": result.error})
+            # Events travel back with the result, so that pool workers need no sink of their own. Those of the next
+            # scan, already started, stay for its own result.
+            result.events = instrumentation.sinks[0].drain(self.image_file)
+        return result
+
+
+def start_image(slicer, image_file, output_dir, update_status_callback=no_status, input_root=None,
+                output_format=None, writer=None):
+    # process_image, errors caught so that a batch goes on
+    started = time.perf_counter()
+    try:
+        return PendingResult(slicer, image_file, started, process_image(slicer, image_file, output_dir,
+                                                                        update_status_callback, input_root,
+                                                                        output_format, writer))
+    except Exception as e:
+        return PendingResult(slicer, image_file, started, error=f"{type(e).__name__}: {e}")
+
+
+def process_image_isolated(slicer, image_file, output_dir, update_status_callback=no_status, input_root=None,
+                           output_format=None, writer=None):
+    return start_image(slicer, image_file, output_dir, update_status_callback, input_root, output_format,
+                       writer).result()
+
+
+def collecting_instrumentation(enabled):
+    return Instrumentation([MemorySink()] if enabled else None)
+
+
+# Each pool process owns one Autoslicer and one SliceWriter, built once by the initializer
+_worker_slicer = None
+_worker_writer = None
+
+
+def _init_worker(param_values, cv_threads, export_workers, memory_budget_mb, instrumented):
+    global _worker_slicer, _worker_writer
+    # One OpenCV thread per process, otherwise workers oversubscribe the cores
+    cv2.setNumThreads(cv_threads)
+    params = AutoslicerParams()
+    params.set_values(param_values)
+    _worker_slicer = Autoslicer(params)
+    _worker_slicer.export_workers = export_workers
+    _worker_slicer.memory_budget_mb = memory_budget_mb
+    _worker_slicer.instrumentation = collecting_instrumentation(instrumented)
+    # Its threads end with the process; every job waits for its slices, nothing is left to write by then
+    _worker_writer = _worker_slicer.slice_writer()
+
+
+def _worker_process(job):
+    image_file, output_dir, input_root, output_format = job
+    return process_image_isolated(_worker_slicer, image_file, output_dir, input_root=input_root,
+                                  output_format=output_format, writer=_worker_writer)
+
+
+def run_batch(image_files, output_dir, param_values, workers=1, update_status_callback=no_status,
+              memory_budget_mb=0, instrumentation=None, input_root=None, output_format=None):
+    # Yields one BatchResult per input, in input order. workers=0 uses all cores.
+    # image_files may be any iterable, e.g. a discovery generator: scans are processed as they come in.
+    # With input_root, output subdirectories mirror the input tree, see scan_output_dir.
+    # Slices are written in output_format if given, otherwise in the format of their scan.
+    # memory_budget_mb > 0 loads scans larger than the budget tiled, see Autoslicer.load_image.
+    # The events of every scan are forwarded to instrumentation, if given, as its result comes in.
+    instrumented = instrumentation is not None and instrumentation.enabled()
+
+    if workers is None or workers <= 0:
+        workers = os.cpu_count() or 1
+
+    if workers == 1:
+        params = AutoslicerParams()
+        params.set_values(param_values)
+        slicer = Autoslicer(params)
+        slicer.memory_budget_mb = memory_budget_mb
+        slicer.instrumentation = collecting_instrumentation(instrumented)
+        # The slices of a scan are written while the next one is loaded and detected, its result comes after.
+        # Not with a memory budget, two scans would be in memory at once.
+        in_flight = 1 if memory_budget_mb > 0 else 2
+        with slicer.slice_writer() as writer:
+            pending = []
+            for image_file in image_files:
+                pending.append(start_image(slicer, image_file, output_dir, update_status_callback, input_root,
+                                           output_format, writer))
+                if len(pending) == in_flight:
+                    result = pending.pop(0).result()
+                    forward_events(result, instrumentation)
+                    yield result
+            for scan in pending:
+                result = scan.result()
+                forward_events(result, instrumentation)
+                yield result
+        return
+
+    # Slice export threads share whatever cores the processes leave free
+    export_workers = max(1, (os.cpu_count() or 1) // workers)
+    jobs = ((image_file, output_dir, input_root, output_format) for image_file in image_files)
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(param_values, 1, export_workers, memory_budget_mb, instrumented)) as pool:
+        for result in pool.imap(_worker_process, jobs):
+            forward_events(result, instrumentation)
+            yield result
+
+
+def queue_name(image_file, input_dir):
+    # Names in a shared work queue are relative to the input directory with / separators, so that machines may
+    # mount the share at different places
+    return os.path.relpath(image_file, input_dir).replace(os.sep, "/")
+
+
+def queue_path(name, input_dir):
+    return os.path.join(input_dir, *name.split("/"))
+
+
+def run_queue(work_queue, input_dir, output_dir, param_values, workers=1, update_status_callback=no_status,
+              memory_budget_mb=0, instrumentation=None, input_root=None, output_format=None, worker_id=None,
+              poll_s=10):
+    # Claims scans from a work queue shared with other machines, see workqueue.DirectoryQueue, until it is
+    # drained. Yields one BatchResult per scan processed here, in completion order; the queue records it.
+    # At most workers scans are claimed at a time, and their leases are renewed while they are processed. With
+    # nothing left to claim but scans still held elsewhere, the worker polls in case a lease runs out.
+    # Other arguments as in run_batch.
+    instrumented = instrumentation is not None and instrumentation.enabled()
+    worker_id = worker_id if worker_id is not None else default_worker_id()
+    if workers is None or workers <= 0:
+        workers = os.cpu_count() or 1
+
+    keeper = LeaseKeeper(work_queue, worker_id)
+    if workers == 1:
+        params = AutoslicerParams()
+        params.set_values(param_values)
+        slicer = Autoslicer(params)
+        slicer.memory_budget_mb = memory_budget_mb
+        slicer.instrumentation = collecting_instrumentation(instrumented)
+        writer = slicer.slice_writer()
+    else:
+        export_workers = max(1, (os.cpu_count() or 1) // workers)
+        pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                    initargs=(param_values, 1, export_workers, memory_budget_mb, instrumented))
+    results = queue.Queue()
+    in_flight = {}
+
+    try:
+        while True:
+            while len(in_flight) < workers:
+                name = work_queue.claim(worker_id)
+                if name is None:
+                    break
+                keeper.hold(name)
+                image_file = queue_path(name, input_dir)
+                in_flight[image_file] = name
+                if workers == 1:
+                    results.put(process_image_isolated(slicer, image_file, output_dir, update_status_callback,
+                                                       input_root, output_format, writer))
+                else:
+                    pool.apply_async(_worker_process, ((image_file, output_dir, input_root, output_format),),
+                                     callback=results.put,
+                                     error_callback=lambda e, f=image_file: results.put(
+                                         BatchResult(f, error=f"{type(e).__name__}: {e}")))
+
+            if not in_flight:
+                if not work_queue.unfinished():
+                    return
+                update_status_callback("Waiting for scans held by other workers...")
+                time.sleep(poll_s)
+                continue
+
+            result = results.get()
+            name = in_flight.pop(result.image_file)
+            keeper.release(name)
+            forward_events(result, instrumentation)
+            if not work_queue.complete(name, worker_id, result.outputs, result.error):
+                update_status_callback(f"Lost the lease of {name}, it is processed again elsewhere")
+            yield result
+    finally:
+        keeper.close()
+        if workers == 1:
+            writer.close()
+        else:
+            pool.terminate()
+            pool.join()
+
+
+def forward_events(result, instrumentation):
+    if instrumentation is not None:
+        for event in result.events:
+            instrumentation.emit(event)
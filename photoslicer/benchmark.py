@@ -0,0 +1,388 @@
+import os
+import json
+import time
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+import cv2
+from autoslicer import Autoslicer, AutoslicerParams
+from instrumentation import Instrumentation, MemorySink
+from geometry import overlapping_pairs, order_corners
+from filters import box_cascade_blur, fast_adaptive_threshold, downsampled_dilate
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+A4_INCHES = (8.27, 11.69)
+
+# How far the fast filter engines may deviate from the exact filters: the largest difference of a blurred pixel,
+# the share of pixels a threshold or dilate sets differently, and the lowest IoU of a quad detected with the fast
+# engines against the one the exact engines detect
+ENGINE_BOUNDS = {"blur_max_diff": 4, "threshold_mismatch": 0.01, "dilate_mismatch": 0.01, "quad_min_iou": 0.98}
+ENGINE_KERNELS = {"blur": (15, 31, 61, 101), "threshold": (15, 51, 301, 1001), "dilate": (16, 64, 200, 500)}
+# Detection settings under which each fast engine is compared on detected quads, the other engines exact: each one
+# must take the fast path, e.g. the dilate kernel must be larger than what downsampled_dilate does exactly
+ENGINE_QUAD_CASES = {"blur": {"gaussian": 20, "blur_engine": 1},
+                     "threshold": {"bw_method": 1, "bw_gauss": 601, "threshold_engine": 1},
+                     "dilate": {"dilate_kernel": 100, "dilate_engine": 1}}
+
+def synthetic_scan(dpi, n_photos, background="white", seed=0):
+    # A flatbed scan of n_photos rotated, slightly perspective-skewed photos laid out on a grid.
+    # Returns the BGR scan and the ground truth quad of each photo, top left corner first.
+    rng = np.random.default_rng(seed)
+    w, h = int(A4_INCHES[0] * dpi), int(A4_INCHES[1] * dpi)
+
+    if background == "noisy":
+        scan = rng.normal(235, 8, (h, w)).clip(0, 255).astype(np.uint8)
+        scan = cv2.cvtColor(cv2.GaussianBlur(scan, (3, 3), 0), cv2.COLOR_GRAY2BGR)
+        # Dust specks
+        for _ in range(int(w * h / 2000)):
+            center = (int(rng.integers(0, w)), int(rng.integers(0, h)))
+            cv2.circle(scan, center, int(rng.integers(1, 3)), (int(rng.integers(60, 200)),) * 3, -1)
+    else:
+        scan = np.full((h, w, 3), 250, np.uint8)
+
+    cols = max(int(np.ceil(np.sqrt(n_photos * w / h))), 1)
+    rows = max(int(np.ceil(n_photos / cols)), 1)
+    cell_w, cell_h = w / cols, h / rows
+
+    quads = []
+    for i in range(n_photos):
+        cx = (i % cols + 0.5) * cell_w + rng.uniform(-0.03, 0.03) * cell_w
+        cy = (i // cols + 0.5) * cell_h + rng.uniform(-0.03, 0.03) * cell_h
+        pw = cell_w * rng.uniform(0.7, 0.8)
+        ph = min(pw * rng.uniform(0.65, 0.8), cell_h * 0.8)
+
+        # Photo content: smooth random colors, darker than the paper
+        photo = rng.integers(20, 180, (8, 8, 3), dtype=np.uint8)
+        photo = cv2.resize(photo, (int(pw), int(ph)), interpolation=cv2.INTER_CUBIC)
+
+        # Rotated rectangle, then each corner nudged for a slight perspective skew
+        quad = cv2.boxPoints(((cx, cy), (pw, ph), rng.uniform(-10, 10)))
+        quad += rng.uniform(-0.008, 0.008, (4, 2)) * np.float32([pw, ph])
+        quad = order_corners(quad)[0].astype(np.float32)
+
+        src = np.float32([[0, 0], [photo.shape[1], 0], [photo.shape[1], photo.shape[0]], [0, photo.shape[0]]])
+        transform = cv2.getPerspectiveTransform(src, quad)
+        warped = cv2.warpPerspective(photo, transform, (w, h), flags=cv2.INTER_LINEAR)
+        mask = cv2.warpPerspective(np.full(photo.shape[:2], 255, np.uint8), transform, (w, h))
+        scan[mask > 127] = warped[mask > 127]
+        quads.append(quad)
+
+    return scan, quads
+
+
+def match_quads(detected, truth):
+    # Greedy one to one matching by IoU; returns the IoU of each matched ground truth quad
+    i, j, iou = overlapping_pairs(detected, truth)
+    pairs = sorted(zip(iou.tolist(), i.tolist(), j.tolist()), reverse=True)
+    used_d, used_t, ious = set(), set(), []
+    for iou, i, j in pairs:
+        if iou <= 0 or i in used_d or j in used_t:
+            continue
+        used_d.add(i)
+        used_t.add(j)
+        ious.append(iou)
+    return ious
+
+
+def measure(fn):
+    # Runs fn, returning its result, duration and the peak of memory allocated meanwhile (numpy buffers included)
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, duration, peak
+
+
+def benchmark_case(scan, truth, param_values, repeat=1, encode_formats=("png", "jpg")):
+    params = AutoslicerParams()
+    params.set_values(param_values)
+    slicer = Autoslicer(params)
+    events = MemorySink()
+    slicer.instrumentation = Instrumentation([events])
+    slicer.image = scan
+    slicer.image_gray = cv2.cvtColor(scan, cv2.COLOR_BGR2GRAY)
+
+    # Best of repeat; the stage cache is off, every stage runs every time
+    detect_s, stages, detect_peak, boxes = None, None, 0, []
+    for _ in range(repeat):
+        events.drain()
+        (boxes, _), duration, peak = measure(lambda: slicer.autodetect_slices(preview=False))
+        if detect_s is None or duration < detect_s:
+            detect_s = duration
+            stages = {event["stage"]: event["duration_s"] for event in events.drain() if event["stage"] != "detect"}
+        detect_peak = max(detect_peak, peak)
+
+    # Export: warp and encode timed separately
+    warp_s, export_peak, slices = 0, 0, []
+    for box in boxes:
+        best = None
+        for _ in range(repeat):
+            slice_img, duration, peak = measure(lambda: slicer.render_slice(box))
+            best = duration if best is None else min(best, duration)
+            export_peak = max(export_peak, peak)
+        warp_s += best
+        slices.append(slice_img)
+
+    encode_s = {}
+    for fmt in encode_formats:
+        total = 0
+        for slice_img in slices:
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                cv2.imencode("." + fmt, slice_img, slicer.params.encode_params(fmt))
+                duration = time.perf_counter() - start
+                best = duration if best is None else min(best, duration)
+            total += best
+        encode_s[fmt] = total
+
+    ious = match_quads(boxes, truth)
+    return {
+        "detect_s": detect_s,
+        "stages_s": stages,
+        "detect_peak_mb": detect_peak / 2 ** 20,
+        "warp_s": warp_s,
+        "encode_s": encode_s,
+        "export_peak_mb": export_peak / 2 ** 20,
+        "detected": len(boxes),
+        "truth": len(truth),
+        "matched": len(ious),
+        "false_positives": len(boxes) - len(ious),
+        "mean_iou": float(np.mean(ious)) if ious else 0.0,
+        "min_iou": float(np.min(ious)) if ious else 0.0,
+    }
+
+
+def engine_deviation(scan, param_values, kernels=None):
+    # Fast filter engines against the exact ones on one scan, per stage and kernel size, then on detected quads
+    kernels = kernels if kernels is not None else ENGINE_KERNELS
+    gray = cv2.cvtColor(scan, cv2.COLOR_BGR2GRAY)
+    binary = cv2.threshold(gray, 200, 255, cv2.THRESH_BINARY_INV)[1]
+    pixels = gray.shape[0] * gray.shape[1]
+    deviation = {"blur_max_diff": {}, "threshold_mismatch": {}, "dilate_mismatch": {}}
+
+    for ksize in kernels["blur"]:
+        exact = cv2.GaussianBlur(gray, (ksize, ksize), 0)
+        deviation["blur_max_diff"][ksize] = int(cv2.absdiff(exact, box_cascade_blur(gray, ksize)).max())
+    for block in kernels["threshold"]:
+        exact = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, block, 2)
+        fast = fast_adaptive_threshold(gray, block, 2)
+        deviation["threshold_mismatch"][block] = cv2.countNonZero(cv2.compare(exact, fast, cv2.CMP_NE)) / pixels
+    for size in kernels["dilate"]:
+        exact = cv2.dilate(binary, np.ones((size, size), np.uint8))
+        fast = downsampled_dilate(binary, size)
+        deviation["dilate_mismatch"][size] = cv2.countNonZero(cv2.compare(exact, fast, cv2.CMP_NE)) / pixels
+
+    deviation["quads"] = {}
+    for stage, case_values in ENGINE_QUAD_CASES.items():
+        exact_values = dict(param_values, blur_engine=0, threshold_engine=0, dilate_engine=0)
+        exact_values.update((name, 0 if name.endswith("_engine") else value) for name, value in case_values.items())
+        quads = []
+        for values in (exact_values, dict(exact_values, **case_values)):
+            params = AutoslicerParams()
+            params.set_values(values)
+            slicer = Autoslicer(params)
+            slicer.load_array(scan)
+            quads.append(slicer.autodetect_slices(preview=False)[0])
+        ious = match_quads(quads[1], quads[0])
+        deviation["quads"][stage] = {"exact": len(quads[0]), "fast": len(quads[1]),
+                                     "min_iou": float(np.min(ious)) if ious else 0.0}
+    return deviation
+
+
+def check_engine_deviation(name, deviation, bounds=None):
+    # Lists where the fast engines deviate more than bounds allow
+    bounds = bounds if bounds is not None else ENGINE_BOUNDS
+    violations = []
+    for metric in ("blur_max_diff", "threshold_mismatch", "dilate_mismatch"):
+        for ksize, value in deviation[metric].items():
+            if value > bounds[metric]:
+                violations.append(f"{name}: {metric} {value:.4g} at kernel {ksize}, bound {bounds[metric]}")
+    for stage, quads in deviation["quads"].items():
+        if quads["exact"] == 0:
+            # Nothing to compare: the case does not check the engine, its settings need fixing
+            violations.append(f"{name}: no photo found with the exact {stage} filter, the case checks nothing")
+        elif quads["fast"] != quads["exact"]:
+            violations.append(f"{name}: {quads['fast']} quads with the fast {stage} engine, "
+                              f"{quads['exact']} with the exact one")
+        elif quads["min_iou"] < bounds["quad_min_iou"]:
+            violations.append(f"{name}: {stage} quad IoU {quads['min_iou']:.4f}, bound {bounds['quad_min_iou']}")
+    return violations
+
+
+def run_engine_check(dpis=(150, 300), photo_counts=(4,), backgrounds=("white", "noisy"), param_values=None, seed=0,
+                     bounds=None, update_status_callback=print):
+    # Returns the deviation of every case and the violations of bounds
+    if param_values is None:
+        param_values = AutoslicerParams().values()
+
+    cases, violations = [], []
+    for dpi in dpis:
+        for n_photos in photo_counts:
+            for background in backgrounds:
+                name = f"{dpi}dpi_{n_photos}photos_{background}"
+                update_status_callback("Checking filter engines on " + name + "...")
+                scan, _ = synthetic_scan(dpi, n_photos, background, seed)
+                deviation = engine_deviation(scan, param_values)
+                cases.append(dict(deviation, name=name))
+                violations += check_engine_deviation(name, deviation, bounds)
+    return cases, violations
+
+
+def format_engine_deviation(cases):
+    # Pixel deviation of each filter, then per engine: photos found fast/exact and the lowest quad IoU
+    stages = list(ENGINE_QUAD_CASES)
+    lines = [f"{'case':<28}{'blur diff':>10}{'thresh %':>10}{'dilate %':>10}"
+             + "".join(f"{stage + ' quads':>18}" for stage in stages)]
+    for case in cases:
+        line = (f"{case['name']:<28}{max(case['blur_max_diff'].values(), default=0):>10}"
+                f"{max(case['threshold_mismatch'].values(), default=0) * 100:>10.3f}"
+                f"{max(case['dilate_mismatch'].values(), default=0) * 100:>10.3f}")
+        for stage in stages:
+            quads = case["quads"][stage]
+            line += f"{quads['fast']:>6}/{quads['exact']:<3}{quads['min_iou']:>9.4f}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def decode_case(scan_path, out_dir, param_values, repeat=1):
+    # Best time of loading, detecting and exporting a scan file, decoded grayscale first then in colour when
+    # exported, and in colour at once with the grayscale image derived from it
+    params = AutoslicerParams()
+    params.set_values(param_values)
+    timings = {}
+    for mode, color in (("gray_first", False), ("color", True)):
+        slicer = Autoslicer(params)
+        best = None
+        for _ in range(repeat):
+            def run():
+                slicer.load_image(scan_path, color)
+                boxes, _ = slicer.autodetect_slices(preview=False)
+                ext = os.path.splitext(scan_path)[1]
+                return slicer.save_slices(boxes, [os.path.join(out_dir, f"{mode}_{i}{ext}") for i in range(len(boxes))])
+            start = time.perf_counter()
+            outputs = run()
+            duration = time.perf_counter() - start
+            best = duration if best is None else min(best, duration)
+        timings[mode + "_s"] = best
+        timings["slices"] = len(outputs)
+    return timings
+
+
+def run_decode_check(dpis=(150, 300, 600), photo_counts=(0, 4), backgrounds=("white",), repeat=3,
+                     param_values=None, seed=0, update_status_callback=print):
+    # Compares the two ways load_image decodes a JPEG scan, see decode_case
+    if param_values is None:
+        param_values = AutoslicerParams().values()
+
+    cases = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for dpi in dpis:
+            for n_photos in photo_counts:
+                for background in backgrounds:
+                    name = f"{dpi}dpi_{n_photos}photos_{background}"
+                    update_status_callback("Decoding " + name + "...")
+                    scan, _ = synthetic_scan(dpi, n_photos, background, seed)
+                    scan_path = os.path.join(tmp_dir, name + ".jpg")
+                    cv2.imwrite(scan_path, scan)
+                    cases.append(dict(decode_case(scan_path, tmp_dir, param_values, repeat), name=name))
+    return cases
+
+
+def format_decode_check(cases):
+    lines = [f"{'case':<28}{'slices':>7}{'gray first ms':>15}{'colour ms':>11}"]
+    for case in cases:
+        lines.append(f"{case['name']:<28}{case['slices']:>7}{case['gray_first_s'] * 1000:>15.1f}"
+                     f"{case['color_s'] * 1000:>11.1f}")
+    return "\n".join(lines)
+
+
+def run_benchmark(dpis=(150, 300, 600), photo_counts=(1, 4, 8), backgrounds=("white", "noisy"), repeat=3,
+                  param_values=None, seed=0, update_status_callback=print):
+    if param_values is None:
+        param_values = AutoslicerParams().values()
+
+    cases = []
+    for dpi in dpis:
+        for n_photos in photo_counts:
+            for background in backgrounds:
+                name = f"{dpi}dpi_{n_photos}photos_{background}"
+                update_status_callback("Benchmarking " + name + "...")
+                scan, truth = synthetic_scan(dpi, n_photos, background, seed)
+                case = {"name": name, "dpi": dpi, "photos": n_photos, "background": background,
+                        "pixels": scan.shape[0] * scan.shape[1]}
+                case.update(benchmark_case(scan, truth, param_values, repeat))
+                cases.append(case)
+
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {"python": platform.python_version(), "opencv": cv2.__version__, "numpy": np.__version__,
+                        "machine": platform.machine(), "cpus": os.cpu_count()},
+        "params": param_values,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource is not None else None,
+        "cases": cases,
+    }
+
+
+def compare_results(baseline, current, time_tolerance=0.15, min_time_s=0.005, iou_tolerance=0.01):
+    # Lists regressions of current against baseline: slower stages, more memory, worse detection
+    regressions = []
+    baseline_cases = {case["name"]: case for case in baseline["cases"]}
+
+    def check_time(name, metric, old, new):
+        if new > old * (1 + time_tolerance) and new - old > min_time_s:
+            regressions.append(f"{name}: {metric} {old * 1000:.1f} ms -> {new * 1000:.1f} ms")
+
+    for case in current["cases"]:
+        old = baseline_cases.get(case["name"])
+        if old is None:
+            continue
+        name = case["name"]
+
+        check_time(name, "detect", old["detect_s"], case["detect_s"])
+        check_time(name, "warp", old["warp_s"], case["warp_s"])
+        for stage, duration in case["stages_s"].items():
+            if stage in old["stages_s"]:
+                check_time(name, stage, old["stages_s"][stage], duration)
+        for fmt, duration in case["encode_s"].items():
+            if fmt in old["encode_s"]:
+                check_time(name, "encode " + fmt, old["encode_s"][fmt], duration)
+
+        for metric in ("detect_peak_mb", "export_peak_mb"):
+            if case[metric] > old[metric] * (1 + time_tolerance) and case[metric] - old[metric] > 1:
+                regressions.append(f"{name}: {metric} {old[metric]:.1f} -> {case[metric]:.1f}")
+
+        if case["matched"] < old["matched"]:
+            regressions.append(f"{name}: matched photos {old['matched']} -> {case['matched']}")
+        if case["false_positives"] > old["false_positives"]:
+            regressions.append(f"{name}: false positives {old['false_positives']} -> {case['false_positives']}")
+        if case["mean_iou"] < old["mean_iou"] - iou_tolerance:
+            regressions.append(f"{name}: mean IoU {old['mean_iou']:.4f} -> {case['mean_iou']:.4f}")
+
+    return regressions
+
+
+def format_results(results):
+    lines = [f"{'case':<28}{'detect ms':>10}{'warp ms':>9}{'png ms':>8}{'found':>7}{'mean IoU':>10}{'peak MB':>9}"]
+    for case in results["cases"]:
+        lines.append(f"{case['name']:<28}{case['detect_s'] * 1000:>10.1f}{case['warp_s'] * 1000:>9.1f}"
+                     f"{case['encode_s'].get('png', 0) * 1000:>8.1f}{case['matched']:>4}/{case['truth']:<2}"
+                     f"{case['mean_iou']:>10.4f}{case['detect_peak_mb']:>9.1f}")
+    return "\n".join(lines)
+
+
+def save_results(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
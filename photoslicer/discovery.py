@@ -0,0 +1,64 @@
+import os
+from fnmatch import fnmatch
+
+IMAGE_PATTERNS = ("*.jpg", "*.jpeg", "*.png", "*.tif", "*.tiff", "*.bmp", "*.gif")
+
+
+def split_patterns(text):
+    # "*.jpg,*.png" -> ("*.jpg", "*.png")
+    return tuple(p.strip() for p in text.split(",") if p.strip())
+
+
+def matches(name, rel_path, patterns):
+    # Case insensitive, against the bare name or the path relative to the root ("/" separated)
+    name, rel_path = name.lower(), rel_path.lower()
+    return any(fnmatch(name, p.lower()) or fnmatch(rel_path, p.lower()) for p in patterns)
+
+
+def path_key(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+def discover_images(root, include=IMAGE_PATTERNS, exclude=(), recursive=True, onerror=None, exclude_dirs=()):
+    # Yields the paths of the files under root matching include and not exclude, while directories are being
+    # read: the first scans come out before the tree, or even one directory, has been listed completely.
+    # Excluded directories are not entered, nor are exclude_dirs, compared by path rather than pattern, e.g. an
+    # output directory inside the tree. Directory symlinks are not followed, so links cannot loop.
+    excluded_dirs = set(path_key(path) for path in exclude_dirs)
+    # Files come in directory order; sort the output if a stable order matters more than streaming.
+    pending = [(root, "")]
+    while pending:
+        path, rel_dir = pending.pop()
+        subdirs = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    rel_path = rel_dir + entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if recursive and not matches(entry.name, rel_path, exclude) and \
+                                    path_key(entry.path) not in excluded_dirs:
+                                subdirs.append((entry.path, rel_path + "/"))
+                        elif entry.is_file() and matches(entry.name, rel_path, include) and \
+                                not matches(entry.name, rel_path, exclude):
+                            yield entry.path
+                    except OSError as e:
+                        if onerror is not None:
+                            onerror(e)
+        except OSError as e:
+            if onerror is not None:
+                onerror(e)
+            continue
+
+        # Depth first, subdirectories in directory order
+        pending.extend(reversed(subdirs))
+
+
+def unique_paths(paths, seen=None):
+    # Drops paths already yielded, or already in seen, comparing normalized absolute paths
+    seen = set() if seen is None else seen
+    for path in paths:
+        key = path_key(path)
+        if key not in seen:
+            seen.add(key)
+            yield path
@@ -0,0 +1,65 @@
+import cv2
+import numpy as np
+
+# Fast approximations of the large kernel filters of the detection chain. Their cost does not grow with the
+# kernel size: box filters are computed with running sums, like an integral image, whatever their width.
+# Below MIN_FAST_KSIZE a box cascade is a poor Gaussian and no faster, the exact filters are used instead.
+MIN_FAST_KSIZE = 15
+
+
+def gaussian_sigma(ksize):
+    # The sigma cv2.GaussianBlur and cv2.adaptiveThreshold derive from a kernel size when given none
+    return 0.3 * ((ksize - 1) * 0.5 - 1) + 0.8
+
+
+def box_cascade_sizes(sigma, passes=3):
+    # Widths of successive box filters whose combined variance matches a Gaussian of the given sigma
+    # (W. Wells, "Efficient synthesis of Gaussian filters by cascaded uniform filters", 1986)
+    ideal = np.sqrt(12 * sigma ** 2 / passes + 1)
+    lower = int(np.floor(ideal))
+    if lower % 2 == 0:
+        lower -= 1
+    lower = max(lower, 1)
+    upper = lower + 2
+    m = round((12 * sigma ** 2 - passes * lower ** 2 - 4 * passes * lower - 3 * passes) / (-4 * lower - 4))
+    m = min(max(m, 0), passes)
+    return [lower] * m + [upper] * (passes - m)
+
+
+def box_cascade_blur(img, ksize, border=cv2.BORDER_REFLECT_101):
+    # Approximates cv2.GaussianBlur(img, (ksize, ksize), 0)
+    if ksize < MIN_FAST_KSIZE:
+        return cv2.GaussianBlur(img, (ksize, ksize), 0, borderType=border)
+    for width in box_cascade_sizes(gaussian_sigma(ksize)):
+        if width > 1:
+            img = cv2.blur(img, (width, width), borderType=border)
+    return img
+
+
+def fast_adaptive_threshold(gray, block, c):
+    # Approximates cv2.adaptiveThreshold(gray, 255, ADAPTIVE_THRESH_GAUSSIAN_C, THRESH_BINARY, block, c):
+    # a pixel is white when brighter than its Gaussian weighted neighbourhood mean minus c.
+    # mean - c saturates at 0, which only differs for black pixels in neighbourhoods darker than c.
+    if block < MIN_FAST_KSIZE:
+        return cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, block, c)
+    mean = box_cascade_blur(gray, block, cv2.BORDER_REPLICATE)
+    return cv2.compare(gray, cv2.subtract(mean, c), cv2.CMP_GT)
+
+
+def downsampled_dilate(binary, size, max_size=64):
+    # Approximates cv2.dilate with a size x size square for large sizes: the binary image is max pooled by a
+    # factor that brings the kernel down to max_size, dilated, and scaled back. Edges of white areas move by up to
+    # one pooling block.
+    factor = int(np.ceil(size / max_size))
+    if factor <= 1:
+        return cv2.dilate(binary, np.ones((size, size), np.uint8))
+
+    h, w = binary.shape[:2]
+    pooled_w, pooled_h = -(-w // factor), -(-h // factor)
+    padded = cv2.copyMakeBorder(binary, 0, pooled_h * factor - h, 0, pooled_w * factor - w, cv2.BORDER_REPLICATE)
+    pooled = cv2.resize(padded, (pooled_w, pooled_h), interpolation=cv2.INTER_AREA)
+    pooled = cv2.compare(pooled, 0, cv2.CMP_GT)
+
+    kernel = max(int(np.ceil(size / factor)), 1)
+    dilated = cv2.dilate(pooled, np.ones((kernel, kernel), np.uint8))
+    return cv2.resize(dilated, (pooled_w * factor, pooled_h * factor), interpolation=cv2.INTER_NEAREST)[:h, :w]
@@ -0,0 +1,95 @@
+import numpy as np
+import shapely
+from shapely import STRtree
+
+
+# Quads of a scan are kept together in one (N, 4, 2) float array, corners in drawing order.
+# Every function here works on the whole batch at once.
+
+def as_quads(quads):
+    return np.asarray(quads, dtype=np.float64).reshape(-1, 4, 2)
+
+
+def quad_areas(quads):
+    # Shoelace formula, always positive
+    quads = as_quads(quads)
+    x, y = quads[..., 0], quads[..., 1]
+    return np.abs((x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y).sum(axis=1)) / 2
+
+
+def quad_centroids(quads):
+    # Area weighted centroids, the corner mean for degenerate quads
+    quads = as_quads(quads)
+    x, y = quads[..., 0], quads[..., 1]
+    xn, yn = np.roll(x, -1, axis=1), np.roll(y, -1, axis=1)
+    cross = x * yn - xn * y
+    area = cross.sum(axis=1) / 2
+    degenerate = np.abs(area) < 1e-9
+    safe_area = np.where(degenerate, 1, area)
+    centroids = np.stack([((x + xn) * cross).sum(axis=1), ((y + yn) * cross).sum(axis=1)], axis=1) / \
+        (6 * safe_area[:, None])
+    return np.where(degenerate[:, None], quads.mean(axis=1), centroids)
+
+
+def best_rotations(quads, targets):
+    # For each quad, the roll of its corners that brings them closest to the matching target quad corners
+    quads, targets = as_quads(quads), as_quads(targets)
+    rolled = np.stack([np.roll(quads, i, axis=1) for i in range(4)], axis=1)
+    distances = np.linalg.norm(rolled - targets[:, None], axis=3).sum(axis=2)
+    return np.argmin(distances, axis=1)
+
+
+def roll_corners(quads, shifts):
+    # Rolls the corners of each quad by its own shift, like np.roll along the corner axis
+    quads = as_quads(quads)
+    index = (np.arange(4)[None, :] - np.asarray(shifts).reshape(-1, 1)) % 4
+    return np.take_along_axis(quads, index[..., None], axis=1)
+
+
+def order_corners(quads):
+    # Clockwise on screen (y pointing down), starting from the corner closest to the top left
+    quads = as_quads(quads)
+    centers = quads.mean(axis=1, keepdims=True)
+    angles = np.arctan2(quads[..., 1] - centers[..., 1], quads[..., 0] - centers[..., 0])
+    quads = np.take_along_axis(quads, np.argsort(angles, axis=1)[..., None], axis=1)
+    return roll_corners(quads, -np.argmin(quads.sum(axis=2), axis=1))
+
+
+def to_polygons(quads):
+    return shapely.polygons(as_quads(quads))
+
+
+def overlapping_pairs(quads1, quads2):
+    # Index pairs (i, j) for which quads1[i] and quads2[j] overlap, with their IoU.
+    # Candidates come from an STR-tree over quads2, so disjoint quads are never compared.
+    quads1, quads2 = as_quads(quads1), as_quads(quads2)
+    if len(quads1) == 0 or len(quads2) == 0:
+        return np.empty(0, np.intp), np.empty(0, np.intp), np.empty(0)
+
+    polys1, polys2 = to_polygons(quads1), to_polygons(quads2)
+    i, j = STRtree(polys2).query(polys1, predicate="intersects")
+    inter = shapely.area(shapely.intersection(polys1[i], polys2[j]))
+    union = shapely.area(shapely.union(polys1[i], polys2[j]))
+    iou = np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+    return i, j, iou
+
+
+def suppress_overlaps(quads, threshold, fixed=0):
+    # Indices of the quads kept when, in order, a quad is dropped if its IoU with one already kept exceeds
+    # threshold. The first fixed quads are always kept.
+    quads = as_quads(quads)
+    i, j, iou = overlapping_pairs(quads, quads)
+    over = (iou > threshold) & (j < i)
+
+    # For each quad, the earlier quads it overlaps too much
+    earlier = {}
+    for a, b in zip(i[over].tolist(), j[over].tolist()):
+        earlier.setdefault(a, []).append(b)
+
+    kept = []
+    is_kept = np.zeros(len(quads), dtype=bool)
+    for n in range(len(quads)):
+        if n < fixed or not any(is_kept[b] for b in earlier.get(n, ())):
+            is_kept[n] = True
+            kept.append(n)
+    return kept
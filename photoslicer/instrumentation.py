@@ -0,0 +1,138 @@
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+class Instrumentation:
+    # Structured timing events. Every event is a flat dict and is handed to each sink; without sinks nothing is kept.
+    #
+    # Stage events: {"type": "stage", "stage": name, "scan": path, "start": epoch seconds, "duration_s": seconds,
+    #                "cached": bool, ...stage specific fields such as width, height, contours, accepted, rejected}
+    # Scan events:  {"type": "scan", "scan": path, "duration_s": seconds, "slices": count, "error": message or None}
+
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks) if sinks is not None else []
+        self.lock = threading.Lock()
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def enabled(self):
+        return len(self.sinks) > 0
+
+    def emit(self, event):
+        with self.lock:
+            for sink in self.sinks:
+                sink.write(event)
+
+    @contextmanager
+    def stage(self, name, scan=None, **info):
+        # The block may add fields to the yielded dict, e.g. counts only known at the end of the stage
+        event = {"type": "stage", "stage": name, "scan": scan, "start": time.time(), "cached": False}
+        event.update(info)
+        started = time.perf_counter()
+        try:
+            yield event
+        finally:
+            event["duration_s"] = time.perf_counter() - started
+            if self.sinks:
+                self.emit(event)
+
+    def cached_stage(self, name, scan=None, **info):
+        if self.sinks:
+            event = {"type": "stage", "stage": name, "scan": scan, "start": time.time(), "cached": True,
+                     "duration_s": 0.0}
+            event.update(info)
+            self.emit(event)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+class MemorySink:
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def write(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def drain(self, scan=None):
+        # All the events, or those of one scan, the others are kept
+        with self.lock:
+            if scan is None:
+                events, self.events = self.events, []
+            else:
+                events = [event for event in self.events if event.get("scan") == scan]
+                self.events = [event for event in self.events if event.get("scan") != scan]
+        return events
+
+    def close(self):
+        pass
+
+
+class JsonLinesSink:
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def write(self, event):
+        self.file.write(json.dumps(event) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class SummarySink:
+    # Aggregates stage durations and scan totals, and flags scans far slower than the median
+    def __init__(self, outlier_factor=3.0):
+        self.outlier_factor = outlier_factor
+        self.stages = {}
+        self.scans = []
+
+    def write(self, event):
+        if event["type"] == "scan":
+            self.scans.append(event)
+            return
+
+        stats = self.stages.setdefault(event["stage"], {"count": 0, "cached": 0, "total_s": 0.0, "max_s": 0.0,
+                                                        "max_scan": None})
+        stats["count"] += 1
+        if event.get("cached"):
+            stats["cached"] += 1
+        stats["total_s"] += event["duration_s"]
+        if event["duration_s"] > stats["max_s"]:
+            stats["max_s"] = event["duration_s"]
+            stats["max_scan"] = event.get("scan")
+
+    def outliers(self):
+        durations = sorted(scan["duration_s"] for scan in self.scans)
+        if len(durations) < 3:
+            return []
+        median = durations[len(durations) // 2]
+        return sorted((scan for scan in self.scans if scan["duration_s"] > median * self.outlier_factor),
+                      key=lambda scan: -scan["duration_s"])
+
+    def format(self):
+        lines = [f"{'stage':<12}{'runs':>7}{'cached':>8}{'total s':>10}{'mean ms':>10}{'max ms':>10}  slowest scan"]
+        for name, stats in sorted(self.stages.items(), key=lambda item: -item[1]["total_s"]):
+            computed = stats["count"] - stats["cached"]
+            mean = stats["total_s"] / computed if computed > 0 else 0.0
+            lines.append(f"{name:<12}{stats['count']:>7}{stats['cached']:>8}{stats['total_s']:>10.2f}"
+                         f"{mean * 1000:>10.1f}{stats['max_s'] * 1000:>10.1f}  {stats['max_scan'] or ''}")
+
+        if self.scans:
+            total = sum(scan["duration_s"] for scan in self.scans)
+            failed = sum(1 for scan in self.scans if scan.get("error"))
+            lines.append(f"{len(self.scans)} scans, {failed} failed, {total:.2f} s total, "
+                         f"{total / len(self.scans) * 1000:.1f} ms per scan")
+            for scan in self.outliers():
+                lines.append(f"Slow outlier: {scan['scan']} {scan['duration_s'] * 1000:.1f} ms")
+
+        return "\n".join(lines)
+
+    def close(self):
+        pass
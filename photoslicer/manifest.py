@@ -0,0 +1,95 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from slicecache import hash_params
+
+MANIFEST_NAME = "photoslicer_manifest.sqlite"
+
+
+class Manifest:
+    # Record of the scans a batch has processed, kept in the output directory so that an interrupted or repeated
+    # run only redoes what is new, modified, failed, processed with other parameters or whose slices are missing.
+    # A scan counts as unchanged while its size and modification time are.
+    # pending() may be consumed by another thread than the one recording, e.g. the task feeder of a process pool.
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS scans (
+                               path TEXT PRIMARY KEY,
+                               size INTEGER,
+                               mtime_ns INTEGER,
+                               params_hash TEXT,
+                               params TEXT,
+                               outputs TEXT,
+                               error TEXT,
+                               processed_at REAL)""")
+        self.db.commit()
+
+    @classmethod
+    def in_output_dir(cls, output_dir):
+        return cls(os.path.join(output_dir, MANIFEST_NAME))
+
+    def close(self):
+        self.db.close()
+
+    def entry(self, image_file):
+        with self.lock:
+            row = self.db.execute("SELECT size, mtime_ns, params_hash, outputs, error FROM scans WHERE path = ?",
+                                  (os.path.abspath(image_file),)).fetchone()
+        if row is None:
+            return None
+        size, mtime_ns, params_hash, outputs, error = row
+        return {"size": size, "mtime_ns": mtime_ns, "params_hash": params_hash,
+                "outputs": json.loads(outputs) if outputs else [], "error": error}
+
+    def is_done(self, image_file, params_hash):
+        entry = self.entry(image_file)
+        if entry is None or entry["error"] is not None or entry["params_hash"] != params_hash:
+            return False
+        try:
+            st = os.stat(image_file)
+        except OSError:
+            return False
+        return entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns and \
+            all(os.path.exists(path) for path in entry["outputs"])
+
+    def pending(self, image_files, param_values, skipped=None):
+        # Yields the scans that need processing; skipped, if given, is a list the others are appended to
+        params_hash = hash_params(param_values)
+        for image_file in image_files:
+            if self.is_done(image_file, params_hash):
+                if skipped is not None:
+                    skipped.append(image_file)
+                continue
+            yield image_file
+
+    def record(self, result, param_values):
+        # Slices the previous run of this scan wrote and this one did not, e.g. with fewer photos found, are removed.
+        # A failed run keeps track of the slices of the previous one instead, a later success removes them if due.
+        outputs = [os.path.abspath(path) for path in result.outputs]
+        previous = self.entry(result.image_file)
+        if previous is not None and result.ok():
+            for path in set(previous["outputs"]) - set(outputs):
+                if os.path.exists(path):
+                    os.remove(path)
+        elif previous is not None:
+            outputs = previous["outputs"]
+
+        try:
+            st = os.stat(result.image_file)
+            size, mtime_ns = st.st_size, st.st_mtime_ns
+        except OSError:
+            size, mtime_ns = None, None
+
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO scans VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (os.path.abspath(result.image_file), size, mtime_ns, hash_params(param_values),
+                             json.dumps(param_values, sort_keys=True), json.dumps(outputs), result.error,
+                             time.time()))
+            self.db.commit()
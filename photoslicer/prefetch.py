@@ -0,0 +1,89 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from PIL import Image
+from autoslicer import Autoslicer
+
+
+class PrefetchedScan:
+    def __init__(self, slicer, boxes, preview):
+        self.slicer = slicer
+        self.boxes = boxes
+        self.preview = preview
+
+
+def params_key(params):
+    # What the boxes and the preview depend on, as in SliceCache; the encoder settings do not matter here
+    values = params.detection_values()
+    values["preview_filter_output"] = params.preview_filter_output.get()
+    return tuple(sorted(values.items()))
+
+
+class Prefetcher:
+    # Decodes and detects the scans around the current one on background threads, so that moving to them is
+    # instant. Results are keyed by path and the parameter values they depend on: a change of those makes them
+    # unusable and they are dropped at the next schedule(). Workers never touch Tk, they work on a snapshot of the
+    # parameters.
+
+    def __init__(self, cache=None, workers=2, ahead=2, behind=1, memory_budget_mb=0):
+        self.cache = cache
+        self.memory_budget_mb = memory_budget_mb
+        self.ahead = ahead
+        self.behind = behind
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = {}
+
+    def schedule(self, paths, index, params):
+        key = params_key(params)
+        wanted = set()
+        for offset in list(range(1, self.ahead + 1)) + list(range(-1, -self.behind - 1, -1)):
+            if 0 <= index + offset < len(paths):
+                wanted.add((paths[index + offset], key))
+
+        # Drop what fell out of the window or was computed with other parameters
+        for future_key in list(self.futures):
+            if future_key not in wanted:
+                self.futures.pop(future_key).cancel()
+
+        for path, key in wanted:
+            if (path, key) not in self.futures:
+                self.futures[(path, key)] = self.executor.submit(self.prefetch, path, params.snapshot())
+
+    def put(self, path, params, scan):
+        # Keeps a scan that is already loaded, e.g. the one being left, so that going back to it is instant too
+        future = Future()
+        future.set_result(scan)
+        self.futures[(path, params_key(params))] = future
+
+    def take(self, path, params):
+        # Waits for a scan still in progress: it started earlier than a fresh load would
+        future = self.futures.pop((path, params_key(params)), None)
+        if future is None or future.cancelled():
+            return None
+        try:
+            return future.result()
+        except Exception:
+            return None
+
+    def prefetch(self, path, params):
+        slicer = Autoslicer(params)
+        slicer.memory_budget_mb = self.memory_budget_mb
+        slicer.load_image(path)
+        if not slicer.image_loaded():
+            return None
+
+        boxes = None
+        if self.cache is not None:
+            boxes, _ = self.cache.load(path, params.detection_values())
+
+        if boxes is None:
+            boxes, preview = slicer.autodetect_slices()
+            if self.cache is not None:
+                self.cache.store_boxes(path, params.detection_values(), boxes)
+        else:
+            preview = slicer.preview_image()
+        return PrefetchedScan(slicer, boxes, Image.fromarray(preview))
+
+    def shutdown(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.futures = {}
+        self.executor.shutdown(wait=False)
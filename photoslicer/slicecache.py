@@ -0,0 +1,92 @@
+import os
+import json
+import threading
+import hashlib
+import numpy as np
+
+
+def default_cache_dir():
+    return os.path.join(os.path.expanduser("~"), ".cache", "photoslicer")
+
+
+def hash_file(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_params(param_values):
+    return hashlib.sha1(json.dumps(param_values, sort_keys=True).encode()).hexdigest()
+
+
+def _write_json(path, data):
+    # Write then rename, so a crash never leaves a truncated entry behind.
+    # The temporary name is per thread, entries may be written by background prefetching meanwhile.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class SliceCache:
+    # On-disk cache of detected boxes and edited slices, keyed by scan content hash and detection parameters.
+    # Content hashes are indexed by path, size and mtime so that unchanged scans are never read twice.
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir if cache_dir is not None else default_cache_dir()
+
+    def content_hash(self, image_path):
+        image_path = os.path.abspath(image_path)
+        st = os.stat(image_path)
+        index_path = os.path.join(self.cache_dir, "paths",
+                                  hashlib.sha1(image_path.encode()).hexdigest() + ".json")
+
+        index = _read_json(index_path)
+        if index is not None and index.get("size") == st.st_size and index.get("mtime_ns") == st.st_mtime_ns:
+            return index["hash"]
+
+        content_hash = hash_file(image_path)
+        _write_json(index_path, {"path": image_path, "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                                 "hash": content_hash})
+        return content_hash
+
+    def entry_path(self, image_path, param_values):
+        return os.path.join(self.cache_dir, "scans", self.content_hash(image_path), hash_params(param_values) + ".json")
+
+    def load(self, image_path, param_values):
+        entry = _read_json(self.entry_path(image_path, param_values))
+        if entry is None:
+            return None, None
+
+        # Slices may be stored before their scan was ever detected, only a list of boxes is a detection
+        boxes = entry.get("boxes")
+        if boxes is not None:
+            boxes = [np.array(box) for box in boxes]
+        slices = entry.get("slices")
+        if slices is not None:
+            slices = [(np.array(s["bbox"]), s["locked"]) for s in slices]
+        return boxes, slices
+
+    def store_boxes(self, image_path, param_values, boxes):
+        path = self.entry_path(image_path, param_values)
+        entry = _read_json(path) or {}
+        entry["boxes"] = [np.asarray(box).tolist() for box in boxes]
+        _write_json(path, entry)
+
+    def store_slices(self, image_path, param_values, slices):
+        # slices is a list of (bbox, locked); the bbox corner order carries the top edge
+        path = self.entry_path(image_path, param_values)
+        entry = _read_json(path) or {"boxes": None}
+        entry["slices"] = [{"bbox": np.asarray(bbox).tolist(), "locked": bool(locked)} for bbox, locked in slices]
+        _write_json(path, entry)
@@ -1,9 +1,11 @@
+import math
 import tkinter as tk
+from collections import OrderedDict
 import PIL
 from PIL import ImageTk
 from PIL import Image
-from shapely.geometry import Polygon
 import numpy as np
+from geometry import as_quads, quad_centroids, suppress_overlaps
 
 
 def slice_corner_tag(s, c):
@@ -43,13 +45,6 @@ def get_slice_from_tags(tags):
     return tag.split("_")[1]
 
 
-def polys_iou(poly1, poly2):
-    poly_1 = Polygon(poly1)
-    poly_2 = Polygon(poly2)
-    iou = poly_1.intersection(poly_2).area / poly_1.union(poly_2).area
-    return iou
-
-
 class PhotoSlice:
     def __init__(self, bbox=None):
         if bbox is None:
@@ -81,6 +76,10 @@ class PhotoSlice:
 
 class SlicingCanvas(tk.Canvas):
 
+    # Viewport rendering: zoomed image tiles, in canvas pixels, and how many are kept
+    TILE_SIZE = 256
+    TILE_CACHE_SIZE = 512
+
     def enable(self, state='normal'):
 
         def set_status(widget):
@@ -99,11 +98,17 @@ class SlicingCanvas(tk.Canvas):
         self.zoom = 1.0
         self.image = None
         self.image_viewport = None
+        self.viewport_item = None
+        self.viewport_key = None
+        self.tiles = OrderedDict()
+        self.pyramid = []
         self.picture_frame = None
         self.cross = [-1, -1, 8, -1, 8, 1, -8, 1, -8, -1, -1, -1, -1, -8, 1, -8, 1, 8, -1, 8]
         self.origin = [0, 0]
         self._on_bbox_updated = None
         self.slices = []
+        # Canvas items of each slice, kept across redraws: {"edges": [ids], "corners": [ids], "label": id}
+        self.slice_items = []
 
         # Events
         self.bind('<Configure>', self.update_view)
@@ -134,10 +139,15 @@ class SlicingCanvas(tk.Canvas):
             self.yview_moveto(0)
             #self.zoom = 1.0
             self.delete("frame")
+            self.delete("slice")
+            self.slice_items = []
             #self.picture_frame = self.create_rectangle(0, 0, image.width, image.height, outline="", tags=("frame",))
             self.picture_frame = self.create_rectangle(0, 0, image.width*self.zoom, image.height*self.zoom, outline="", tags=("frame",))
             self.slices = []
         self.image = image
+        self.pyramid = [image]
+        self.tiles.clear()
+        self.viewport_key = None
 
     def _get_zoom_automatic(self, image):
         canvas_width = self.winfo_width()
@@ -147,36 +157,20 @@ class SlicingCanvas(tk.Canvas):
 
     def add_bbox(self, bbx):
         self.slices.append(bbx)
-        self.delete("slice")
-        for b in range(len(self.slices)):
-            self.__draw_slice(b)
+        self.__draw_slice(len(self.slices) - 1)
+        self.tag_raise("corner")
 
         self.update_view()
 
     def update_bboxes(self, bbxs=None):
         if bbxs is not None:
-            merged_slices = []
-            for sl in self.slices:
-                if sl.locked:
-                    merged_slices.append(sl)
-
-            for box in bbxs:
-                # Check if bbox is the same as one of the locked slices
-                overlaps_locked = False
-                for sl in merged_slices:
-                    if polys_iou(box, sl.bbox) > 0.3:
-                        overlaps_locked = True
-                        break
-                if not overlaps_locked:
-                    s = PhotoSlice(box)
-                    merged_slices.append(s)
-
-            self.slices = merged_slices
-
-        self.delete("slice")
-        for b in range(len(self.slices)):
-            self.__draw_slice(b)
+            # Locked slices stay, detected boxes are added unless they overlap one already there
+            locked = [sl for sl in self.slices if sl.locked]
+            quads = as_quads([sl.bbox for sl in locked] + list(bbxs))
+            kept = suppress_overlaps(quads, 0.3, fixed=len(locked))
+            self.slices = locked + [PhotoSlice(bbxs[n - len(locked)]) for n in kept[len(locked):]]
 
+        self.draw_slices()
         self.update_view()
 
     def view_drag_start(self, event):
@@ -259,86 +253,136 @@ class SlicingCanvas(tk.Canvas):
         label = self.find_withtag("current")[0]
         s = get_slice_from_tags(self.gettags(label))
         self.slices[int(s)].toggle_locked()
-        self.update_bboxes()
+        self.__draw_slice(int(s))
+
+    def draw_slices(self):
+        # Items of slices that are gone are deleted, the others are only moved and recoloured
+        for si in range(len(self.slices), len(self.slice_items)):
+            self.delete(slice_tag(si))
+        del self.slice_items[len(self.slices):]
+
+        created = len(self.slice_items) < len(self.slices)
+        for si in range(len(self.slices)):
+            self.__draw_slice(si)
+        if created:
+            self.tag_raise("corner")
 
     def __draw_slice(self, si):
         s = self.slices[si]
-        s_tag = slice_tag(si)
-        self.delete(s_tag)
-
-        # Generates edge list
-        edges = []
-        prev = None
-        origin = None
-        for p in s.bbox:
-            if prev is None:
-                prev = p
-                origin = p
-                continue
-            edge = (prev, p)
-            edges.append(edge)
-            prev = p
-        edge = (prev, origin)
-        edges.append(edge)
-
-        # Draw edges
-        for i, e in enumerate(edges):
-            (a, b) = e
-            if i == 0:
-                color = "red"
-            else:
-                if s.locked:
-                    color = "blue"
-                else:
-                    color = "lightgreen"
-
-            self.create_line(a[0] * self.zoom, a[1] * self.zoom, b[0] * self.zoom, b[1] * self.zoom,
-                             fill=color, width=3, tags=(s_tag, slice_edge_tag(si, i), "edge", "slice"))
-
-        # Draw a "cross" at every corner of the bbox
-        for i, p in enumerate(s.bbox):
-            poly = self.create_polygon(self.cross, outline="blue", activeoutline="red",
-                                       fill="gray", stipple='gray12', width=3,
-                                       tags=(s_tag, slice_corner_tag(si, i), "corner", "slice"))
-            self.move(poly, p[0], p[1])
-            self.scale(poly, 0, 0, self.zoom, self.zoom)
-
-        # Draw label
-        center = Polygon(s.bbox).centroid.coords[:]
+
+        # Items are created the first time a slice is drawn, afterwards only their coordinates and colours change
+        if si == len(self.slice_items):
+            s_tag = slice_tag(si)
+            self.slice_items.append({
+                "edges": [self.create_line(0, 0, 0, 0, width=3, tags=(s_tag, slice_edge_tag(si, i), "edge", "slice"))
+                          for i in range(len(s.bbox))],
+                # A "cross" at every corner of the bbox
+                "corners": [self.create_polygon(self.cross, outline="blue", activeoutline="red", fill="gray",
+                                                stipple='gray12', width=3,
+                                                tags=(s_tag, slice_corner_tag(si, i), "corner", "slice"))
+                            for i in range(len(s.bbox))],
+                "label": self.create_text(0, 0, text=str(si), font=('Arial', 20), activefill="red",
+                                          tags=(s_tag, slice_label_tag(si), "label", "slice")),
+            })
+        items = self.slice_items[si]
+
         if s.locked:
             color = "blue"
         else:
             color = "lightgreen"
 
-        label = self.create_text(center, fill=color, text=str(si), font=('Arial', 20), activefill="red",
-                                 tags=(s_tag, slice_label_tag(si), "label", "slice"))
-        self.scale(label, 0, 0, self.zoom, self.zoom)
-        self.tag_raise("corner")
+        # Edges, the top one in red
+        bbox = np.asarray(s.bbox, dtype=np.float64).reshape(-1, 2)
+        zoomed = bbox * self.zoom
+        for i, line in enumerate(items["edges"]):
+            a, b = zoomed[i], zoomed[(i + 1) % len(zoomed)]
+            self.coords(line, a[0], a[1], b[0], b[1])
+            self.itemconfigure(line, fill="red" if i == 0 else color)
+
+        cross = np.reshape(self.cross, (-1, 2))
+        for i, poly in enumerate(items["corners"]):
+            self.coords(poly, *((cross + bbox[i]) * self.zoom).ravel().tolist())
+
+        center = quad_centroids(bbox)[0] * self.zoom
+        self.coords(items["label"], center[0], center[1])
+        self.itemconfigure(items["label"], fill=color)
+
+    # Mipmap level to sample from at the current zoom: the smallest one still at least as large as the view.
+    # Level n is the image halved n times, built from level n - 1 the first time it is needed.
+    def pyramid_level(self):
+        level = max(int(math.floor(math.log2(1 / self.zoom))), 0) if self.zoom < 1 else 0
+        while len(self.pyramid) <= level:
+            previous = self.pyramid[-1]
+            if previous.width < 2 or previous.height < 2:
+                break
+            self.pyramid.append(previous.reduce(2))
+        image = self.pyramid[min(level, len(self.pyramid) - 1)]
+        return image, image.width / self.image.width, image.height / self.image.height
+
+    def render_tile(self, tx, ty, zoomed_w, zoomed_h):
+        key = (self.zoom, tx, ty)
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+            return tile
+
+        x1, y1 = tx * self.TILE_SIZE, ty * self.TILE_SIZE
+        x2, y2 = min(x1 + self.TILE_SIZE, zoomed_w), min(y1 + self.TILE_SIZE, zoomed_h)
+        level, level_sx, level_sy = self.pyramid_level()
+        tile = level.resize((x2 - x1, y2 - y1),
+                            box=(x1 / self.zoom * level_sx, y1 / self.zoom * level_sy,
+                                 min(x2 / self.zoom * level_sx, level.width), min(y2 / self.zoom * level_sy, level.height)))
+
+        self.tiles[key] = tile
+        if len(self.tiles) > self.TILE_CACHE_SIZE:
+            self.tiles.popitem(last=False)
+        return tile
 
     def update_view(self, x=0, y=0):
         if self.image is None:
             return
 
         pic_bbx = self.bbox(self.picture_frame)
-        pic_bbx = (pic_bbx[0] + 1, pic_bbx[1] + 1, pic_bbx[2] - 1, pic_bbx[3] - 1)
-        canvas_bbx = (self.canvasx(0),
-                      self.canvasy(0),
-                      self.canvasx(self.winfo_width()),
-                      self.canvasy(self.winfo_height()))
+        pic_x, pic_y = pic_bbx[0] + 1, pic_bbx[1] + 1
+        zoomed_w = int(self.image.width * self.zoom)
+        zoomed_h = int(self.image.height * self.zoom)
 
-        x1 = max(canvas_bbx[0] - pic_bbx[0], 0)
-        y1 = max(canvas_bbx[1] - pic_bbx[1], 0)
-        x2 = min(canvas_bbx[2], pic_bbx[2]) - pic_bbx[0]
-        y2 = min(canvas_bbx[3], pic_bbx[3]) - pic_bbx[1]
+        # Visible part of the zoomed picture
+        x1 = max(self.canvasx(0) - pic_x, 0)
+        y1 = max(self.canvasy(0) - pic_y, 0)
+        x2 = min(self.canvasx(self.winfo_width()) - pic_x, zoomed_w)
+        y2 = min(self.canvasy(self.winfo_height()) - pic_y, zoomed_h)
 
         if int(x2 - x1) <= 0 or int(y2 - y1) <= 0:
             return
 
-        x = min(int(x2 / self.zoom), self.image.width)
-        y = min(int(y2 / self.zoom), self.image.height)
+        # Tiles covering it; nothing to do if they are the ones on screen already
+        tx1, ty1 = int(x1 // self.TILE_SIZE), int(y1 // self.TILE_SIZE)
+        tx2, ty2 = int((x2 - 1) // self.TILE_SIZE), int((y2 - 1) // self.TILE_SIZE)
+        viewport_key = (self.zoom, tx1, ty1, tx2, ty2)
+        if viewport_key == self.viewport_key and self.viewport_item is not None:
+            return
+        self.viewport_key = viewport_key
+
+        ox, oy = tx1 * self.TILE_SIZE, ty1 * self.TILE_SIZE
+        viewport = Image.new(self.image.mode, (min((tx2 + 1) * self.TILE_SIZE, zoomed_w) - ox,
+                                               min((ty2 + 1) * self.TILE_SIZE, zoomed_h) - oy))
+        for ty in range(ty1, ty2 + 1):
+            for tx in range(tx1, tx2 + 1):
+                viewport.paste(self.render_tile(tx, ty, zoomed_w, zoomed_h),
+                               (tx * self.TILE_SIZE - ox, ty * self.TILE_SIZE - oy))
+
+        # A single canvas image item is reused, its photo image too when the size allows
+        if self.image_viewport is not None and \
+                (self.image_viewport.width(), self.image_viewport.height()) == viewport.size:
+            self.image_viewport.paste(viewport)
+        else:
+            self.image_viewport = ImageTk.PhotoImage(viewport)
 
-        image = self.image.crop((int(x1 / self.zoom), int(y1 / self.zoom), x, y))
-        self.image_viewport = ImageTk.PhotoImage(image.resize((int(x2 - x1), int(y2 - y1))))
-        canvas_image = self.create_image(max(canvas_bbx[0], pic_bbx[0]), max(canvas_bbx[1], pic_bbx[1]),
-                                         anchor='nw', image=self.image_viewport)
-        self.lower(canvas_image)
+        if self.viewport_item is None:
+            self.viewport_item = self.create_image(pic_x + ox, pic_y + oy, anchor='nw', image=self.image_viewport,
+                                                   tags=("viewport",))
+        else:
+            self.coords(self.viewport_item, pic_x + ox, pic_y + oy)
+            self.itemconfigure(self.viewport_item, image=self.image_viewport)
+        self.lower(self.viewport_item)
@@ -0,0 +1,185 @@
+import os
+import json
+import random
+import itertools
+import multiprocessing
+import numpy as np
+import cv2
+from autoslicer import Autoslicer, AutoslicerParams
+from instrumentation import Instrumentation, MemorySink
+from geometry import as_quads, quad_areas, overlapping_pairs
+
+# Parameters in the order of the stages they feed. Combinations sorted this way share their leading stages with
+# the one before, and the single entry stage cache of Autoslicer only recomputes the stages that changed:
+# one blur feeds every threshold, dilate and filter variant after it.
+STAGE_ORDER = ("detect_scale", "gaussian", "blur_engine", "bw_method", "bw_thresh", "bw_gauss", "threshold_engine",
+               "dilate_kernel", "dilate_engine", "bbox_min_size_prop", "bbox_fill_thresh", "refine_edges")
+
+
+def parse_grid(text):
+    # "gaussian=10:20:30,bw_thresh=190:210" -> {"gaussian": [10, 20, 30], "bw_thresh": [190, 210]}
+    grid = {}
+    for assignment in text.split(","):
+        name, values = assignment.split("=")
+        grid[name.strip()] = [int(v) for v in values.split(":")]
+    return grid
+
+
+def parameter_grid(base_values, grid):
+    names = list(grid)
+    for combination in itertools.product(*(grid[name] for name in names)):
+        values = dict(base_values)
+        values.update(zip(names, combination))
+        yield values
+
+
+def random_combinations(base_values, grid, count, seed=0):
+    combinations = list(parameter_grid(base_values, grid))
+    if count < len(combinations):
+        combinations = random.Random(seed).sample(combinations, count)
+    return combinations
+
+
+def stage_order_key(values):
+    return tuple(values.get(name, 0) for name in STAGE_ORDER)
+
+
+def fill_ratios(boxes, filter_out, image_shape):
+    # Share of each box the filter output marks as photo rather than paper (white), at detection resolution
+    scale = filter_out.shape[1] / image_shape[1]
+    ratios = []
+    for box in boxes:
+        mask = np.zeros(filter_out.shape[:2], np.uint8)
+        cv2.fillPoly(mask, [np.int32(np.round(np.asarray(box) * scale))], 255)
+        area = cv2.countNonZero(mask)
+        if area > 0:
+            ratios.append(1 - cv2.countNonZero(cv2.bitwise_and(filter_out, mask)) / area)
+    return ratios
+
+
+def evaluate_scan(image_file, combinations):
+    # Detection with every combination on one scan, in stage order. Returns one metrics dict per combination,
+    # in the order given. The time of a combination is what it would take on its own: the stages it reused
+    # are counted with the duration they had when computed.
+    slicer = Autoslicer(AutoslicerParams())
+    # Combinations in stage order share their leading stages
+    slicer.cache_stages = True
+    events = MemorySink()
+    slicer.instrumentation = Instrumentation([events])
+    slicer.load_image(image_file)
+    load_s = events.drain()[0]["duration_s"]
+    scan_area = slicer.image_shape[0] * slicer.image_shape[1]
+
+    stage_s = {}
+    metrics = [None] * len(combinations)
+    for n in sorted(range(len(combinations)), key=lambda n: stage_order_key(combinations[n])):
+        slicer.params.set_values(combinations[n])
+        boxes, filter_out = slicer.detect_slices(lambda text: None)
+
+        duration = load_s
+        for event in events.drain():
+            if not event.get("cached"):
+                stage_s[event["stage"]] = event["duration_s"]
+            duration += stage_s.get(event["stage"], 0)
+
+        quads = as_quads(boxes)
+        _, _, iou = overlapping_pairs(quads, quads)
+        ratios = fill_ratios(boxes, filter_out, slicer.image_shape)
+        metrics[n] = {
+            "photos": len(boxes),
+            "coverage": float(quad_areas(quads).sum() / scan_area),
+            # Each overlapping pair shows up twice, a box also overlaps itself
+            "overlaps": int((len(iou) - len(boxes)) // 2),
+            "fill": float(np.mean(ratios)) if ratios else 0.0,
+            "time_s": duration,
+        }
+    return image_file, metrics
+
+
+def _sweep_worker(job):
+    # One OpenCV thread per process, scans are the unit of parallelism. A scan that cannot be evaluated, e.g. an
+    # unreadable file, is reported rather than ending the sweep.
+    cv2.setNumThreads(1)
+    try:
+        return evaluate_scan(*job) + (None,)
+    except Exception as e:
+        return job[0], None, f"{type(e).__name__}: {e}"
+
+
+def sample_scans(image_files, count, seed=0):
+    image_files = sorted(image_files)
+    if count is not None and count < len(image_files):
+        image_files = sorted(random.Random(seed).sample(image_files, count))
+    return image_files
+
+
+def run_sweep(image_files, combinations, workers=1, update_status_callback=print, skipped=None):
+    # Evaluates every combination on every scan, one scan per process, and aggregates per combination.
+    # Scans that could not be evaluated are left out; skipped, if given, is a list their (path, error) are added to.
+    combinations = list(combinations)
+    jobs = [(image_file, combinations) for image_file in image_files]
+    if workers is None or workers <= 0:
+        workers = os.cpu_count() or 1
+
+    per_scan = []
+    if workers == 1:
+        results = map(_sweep_worker, jobs)
+    else:
+        pool = multiprocessing.Pool(min(workers, max(len(jobs), 1)))
+        results = pool.imap_unordered(_sweep_worker, jobs)
+    try:
+        for n, (image_file, metrics, error) in enumerate(results):
+            if error is not None:
+                update_status_callback(f"Skipped {image_file}: {error} ({n + 1}/{len(jobs)})")
+                if skipped is not None:
+                    skipped.append((image_file, error))
+                continue
+            update_status_callback(f"Swept {image_file} ({n + 1}/{len(jobs)})")
+            per_scan.append(metrics)
+    finally:
+        if workers != 1:
+            pool.close()
+            pool.join()
+
+    rows = []
+    for n, values in enumerate(combinations):
+        scans = [metrics[n] for metrics in per_scan]
+        photos = [m["photos"] for m in scans]
+        rows.append({
+            "params": values,
+            "photos": photos,
+            "mean_photos": float(np.mean(photos)) if photos else 0.0,
+            "empty_scans": sum(1 for p in photos if p == 0),
+            "coverage": float(np.mean([m["coverage"] for m in scans])) if scans else 0.0,
+            "overlaps": sum(m["overlaps"] for m in scans),
+            "fill": float(np.mean([m["fill"] for m in scans if m["photos"] > 0] or [0.0])),
+            "time_s": float(np.mean([m["time_s"] for m in scans])) if scans else 0.0,
+        })
+    return rows
+
+
+def rank(rows, expected_photos=None):
+    # Best first. With the number of photos expected per scan, the count error comes first; otherwise scans where
+    # nothing was found. Then overlapping boxes, then poorly filled boxes, then time.
+    def key(row):
+        if expected_photos is not None:
+            miss = float(np.mean([abs(p - expected_photos) for p in row["photos"]])) if row["photos"] else 0.0
+        else:
+            miss = row["empty_scans"]
+        return miss, row["overlaps"], -round(row["fill"], 3), row["time_s"]
+    return sorted(rows, key=key)
+
+
+def format_report(rows, varied, top=20):
+    header = "".join(f"{name:>14}" for name in varied)
+    lines = [f"{'rank':>4}{header}{'photos':>8}{'empty':>7}{'overlaps':>9}{'fill':>7}{'coverage':>9}{'ms/scan':>9}"]
+    for i, row in enumerate(rows[:top]):
+        values = "".join(f"{row['params'][name]:>14}" for name in varied)
+        lines.append(f"{i + 1:>4}{values}{row['mean_photos']:>8.2f}{row['empty_scans']:>7}{row['overlaps']:>9}"
+                     f"{row['fill']:>7.3f}{row['coverage']:>9.3f}{row['time_s'] * 1000:>9.1f}")
+    return "\n".join(lines)
+
+
+def save_report(rows, path):
+    with open(path, "w") as f:
+        json.dump(rows, f, indent=2)
@@ -0,0 +1,109 @@
+import tempfile
+import threading
+import cv2
+import numpy as np
+from PIL import Image
+
+
+def estimated_image_bytes(image_path):
+    # Only the header is read
+    with Image.open(image_path) as im:
+        w, h = im.size
+    return w * h * 3
+
+
+def image_header(image_path):
+    # Format and size as cv2.imread returns the image, i.e. with EXIF rotations applied; only the header is read
+    with Image.open(image_path) as im:
+        w, h = im.size
+        orientation = im.getexif().get(0x0112, 1)
+        if orientation in (5, 6, 7, 8):
+            w, h = h, w
+        return im.format, w, h
+
+
+class TiledImage:
+    # A scan kept as a raw raster on disk, of which only the rows a region covers are ever read into memory.
+    # Slicing with [y1:y2, x1:x2] returns a BGR array, so it can stand in for the ndarray from cv2.imread.
+    #
+    # Uncompressed 8-bit RGB or grayscale TIFFs are read straight from the file and never decoded.
+    # Other formats are decoded once into an anonymous scratch file; the decode itself still needs the
+    # whole image in memory, but it is released as soon as it has been written out.
+
+    def __init__(self, raster_file, offset, shape, channel_order):
+        self.raster_file = raster_file
+        self.offset = offset
+        self.raster_shape = shape
+        self.channel_order = channel_order
+        self.shape = shape[:2] + (3,)
+        self.dtype = np.dtype(np.uint8)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def open(cls, image_path):
+        with Image.open(image_path) as im:
+            w, h = im.size
+            raw_tile = None
+            if im.format == "TIFF" and len(im.tile) == 1 and im.mode in ("RGB", "L"):
+                tile = im.tile[0]
+                if tile[0] == "raw" and tile[1] == (0, 0, w, h) and tile[3][0] == im.mode and tile[3][1:] in ((0, 1), ()):
+                    raw_tile = tile[2], im.mode
+
+        if raw_tile is not None:
+            offset, mode = raw_tile
+            shape = (h, w, 3) if mode == "RGB" else (h, w)
+            return cls(open(image_path, "rb"), offset, shape, "RGB" if mode == "RGB" else "L")
+
+        image = cv2.imread(image_path)
+        if image is None:
+            raise IOError("Cannot read " + image_path)
+        scratch = tempfile.TemporaryFile()
+        scratch.write(image.data)
+        shape = image.shape
+        del image
+        return cls(scratch, 0, shape, "BGR")
+
+    def close(self):
+        self.raster_file.close()
+
+    def read_rows(self, y1, y2):
+        row_shape = self.raster_shape[1:]
+        row_bytes = int(np.prod(row_shape))
+        with self.lock:
+            self.raster_file.seek(self.offset + y1 * row_bytes)
+            data = self.raster_file.read((y2 - y1) * row_bytes)
+        return np.frombuffer(data, np.uint8).reshape((-1,) + row_shape)
+
+    def _region(self, index):
+        ys, xs = index[0], index[1] if len(index) > 1 else slice(None)
+        y1, y2, _ = ys.indices(self.raster_shape[0])
+        return self.read_rows(y1, max(y1, y2))[:, xs]
+
+    def __getitem__(self, index):
+        region = np.ascontiguousarray(self._region(index))
+        if self.channel_order == "BGR":
+            return region
+        if self.channel_order == "RGB":
+            return cv2.cvtColor(region, cv2.COLOR_RGB2BGR)
+        return cv2.cvtColor(region, cv2.COLOR_GRAY2BGR)
+
+    def gray(self, index):
+        region = np.ascontiguousarray(self._region(index))
+        if self.channel_order == "L":
+            return region
+        return cv2.cvtColor(region, cv2.COLOR_BGR2GRAY if self.channel_order == "BGR" else cv2.COLOR_RGB2GRAY)
+
+    def reduced_gray(self, factor, band_bytes):
+        # Grayscale image decimated by an integer factor, built band by band. Each output pixel is the mean of a
+        # factor x factor block, so bands join without seams; rows and columns past the last full block are dropped.
+        h, w = self.shape[:2]
+        out_h, out_w = h // factor, w // factor
+        out = np.empty((out_h, out_w), np.uint8)
+        band_rows = max(band_bytes // (w * 3 * factor), 1) * factor
+
+        for y in range(0, out_h * factor, band_rows):
+            rows = min(band_rows, out_h * factor - y)
+            band = self.gray((slice(y, y + rows), slice(0, out_w * factor)))
+            out[y // factor:(y + rows) // factor] = cv2.resize(band, (out_w, rows // factor),
+                                                                interpolation=cv2.INTER_AREA)
+        return out
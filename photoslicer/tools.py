@@ -1,37 +1,37 @@
+import cv2
 import numpy as np
+from geometry import best_rotations
 
 
-def distance_points(a, b):
-    return np.sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2)
+def translation_matrix(dx, dy):
+    return np.array([[1, 0, dx], [0, 1, dy], [0, 0, 1]], dtype=np.float64)
 
 
-def crop_to_circle(img, center, radius):
-    x1 = center[0] - radius
-    y1 = center[1] - radius
-    x2 = center[0] + radius
-    y2 = center[1] + radius
+def warp_roi(img, transform, size, flags=cv2.INTER_LINEAR, margin=3, dst=None):
+    # Warps img into an output of the given size reading only the region the output maps back to.
+    # Pixels outside img are black, as if img had been padded, but no padded copy is made.
+    # dst, if given, is a contiguous array of the output shape and type that is written in place.
+    w, h = size
+    out_corners = np.float32([[-0.5, -0.5], [w - 0.5, -0.5], [w - 0.5, h - 0.5], [-0.5, h - 0.5]])
+    src_corners = cv2.perspectiveTransform(out_corners.reshape(-1, 1, 2), np.linalg.inv(transform)).reshape(4, 2)
 
-    if x1 < 0 or y1 < 0 or x2 > img.shape[1] or y2 > img.shape[0]:
-        img = np.pad(img, ((np.abs(np.minimum(0, y1)), np.maximum(y2 - img.shape[0], 0)),
-                           (np.abs(np.minimum(0, x1)), np.maximum(x2 - img.shape[1], 0)),
-                           (0, 0)),
-                     mode="constant")
+    # Region of interest, enlarged by the interpolation support and clipped to the image
+    x1 = max(int(np.floor(src_corners[:, 0].min())) - margin, 0)
+    y1 = max(int(np.floor(src_corners[:, 1].min())) - margin, 0)
+    x2 = min(int(np.ceil(src_corners[:, 0].max())) + margin + 1, img.shape[1])
+    y2 = min(int(np.ceil(src_corners[:, 1].max())) + margin + 1, img.shape[0])
 
-        y2 += np.abs(np.minimum(0, y1))
-        y1 += np.abs(np.minimum(0, y1))
-        x2 += np.abs(np.minimum(0, x1))
-        x1 += np.abs(np.minimum(0, x1))
+    if x2 <= x1 or y2 <= y1:
+        if dst is None:
+            return np.zeros((h, w) + img.shape[2:], dtype=img.dtype)
+        dst[...] = 0
+        return dst
 
-    return img[y1:y2, x1:x2, :]
+    return cv2.warpPerspective(img[y1:y2, x1:x2], transform @ translation_matrix(x1, y1), (w, h), dst=dst,
+                               flags=flags, borderMode=cv2.BORDER_CONSTANT)
 
 
 def shift_points_to_min_distance(bbox1, bbox2):
-    # TODO check input be quadrilateral
-    dists = np.array([0, 0, 0, 0])
-    for i, d in enumerate(dists):
-        shifted = np.roll(bbox1, i, axis=0)
-        for j, p in enumerate(bbox2):
-            dists[i] += distance_points(shifted[j], p)
-
-    best = np.where(dists == np.amin(dists))
-    return np.roll(bbox1, best[0], axis=0), best[0][0]
+    # Roll of the quad bbox1 whose corners are closest to those of bbox2, and the roll itself
+    best = int(best_rotations(bbox1, bbox2)[0])
+    return np.roll(bbox1, best, axis=0), best
@@ -0,0 +1,297 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from autoslicer import Autoslicer, AutoslicerParams
+from batch import process_image_isolated, collecting_instrumentation, forward_events, no_status
+from discovery import IMAGE_PATTERNS, matches, discover_images, path_key
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct("iIII")
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+
+# Bytes a complete file of these formats ends with, searched for in its last kilobyte: some writers pad the end
+TRAILERS = {".jpg": b"\xff\xd9", ".jpeg": b"\xff\xd9", ".png": b"IEND"}
+
+
+class Inotify:
+    # Minimal binding of Linux inotify(7); raises OSError where it is not available
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        libc = ctypes.CDLL(libc_name, use_errno=True) if libc_name is not None else None
+        if libc is None or not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.watches = {}
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        self.watches[wd] = path
+
+    def read(self, timeout=None):
+        # (directory, name, mask) of the events that came within timeout seconds, None waits for the first one
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            # The watch of a removed or unmounted directory is gone
+            directory = self.watches.pop(wd, None) if mask & IN_IGNORED else self.watches.get(wd)
+            events.append((directory, name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class InotifyWatcher:
+    # Reports the files created, written or moved into the watched tree as the kernel signals them: no CPU is used
+    # while nothing happens. Does not see writes made by other machines to a network share, use PollingWatcher.
+
+    def __init__(self, root, include=IMAGE_PATTERNS, exclude=(), recursive=False, onerror=None, exclude_dirs=()):
+        self.root = root
+        self.include = include
+        self.exclude = exclude
+        self.recursive = recursive
+        self.onerror = onerror
+        self.exclude_dirs = exclude_dirs
+        self.excluded_dirs = set(path_key(path) for path in exclude_dirs)
+        self.inotify = Inotify()
+
+    def rel_path(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, "/")
+
+    def wanted(self, path):
+        name, rel_path = os.path.basename(path), self.rel_path(path)
+        return matches(name, rel_path, self.include) and not matches(name, rel_path, self.exclude)
+
+    def wanted_dir(self, path):
+        return not matches(os.path.basename(path), self.rel_path(path), self.exclude) and \
+            path_key(path) not in self.excluded_dirs
+
+    def discover(self, path):
+        return list(discover_images(path, self.include, self.exclude, self.recursive, self.onerror, self.exclude_dirs))
+
+    def watch_tree(self, path):
+        # Watches path, and its subdirectories if recursive, before listing it: a file created meanwhile is then
+        # reported twice rather than missed. Returns the files already there.
+        directories = [path]
+        while directories:
+            directory = directories.pop()
+            try:
+                self.inotify.add_watch(directory)
+            except OSError as e:
+                if self.onerror is not None:
+                    self.onerror(e)
+                continue
+            if self.recursive:
+                try:
+                    with os.scandir(directory) as entries:
+                        directories.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False)
+                                           and self.wanted_dir(entry.path))
+                except OSError as e:
+                    if self.onerror is not None:
+                        self.onerror(e)
+        return self.discover(path)
+
+    def start(self):
+        # Starts watching, returns the files already there
+        return self.watch_tree(self.root)
+
+    def changes(self, timeout=None):
+        # Paths of the files that changed within timeout seconds, None waits until one does
+        paths = []
+        for directory, name, mask in self.inotify.read(timeout):
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, list everything again
+                paths += self.discover(self.root)
+            elif directory is None or not name:
+                continue
+            elif mask & IN_ISDIR:
+                path = os.path.join(directory, name)
+                if self.recursive and self.wanted_dir(path):
+                    paths += self.watch_tree(path)
+            else:
+                path = os.path.join(directory, name)
+                if self.wanted(path):
+                    paths.append(path)
+        return paths
+
+    def close(self):
+        self.inotify.close()
+
+
+class PollingWatcher:
+    # Lists the tree every interval_s seconds and reports the files that are new or whose size or modification
+    # time changed. Works on any filesystem, network shares included.
+
+    def __init__(self, root, include=IMAGE_PATTERNS, exclude=(), recursive=False, onerror=None, exclude_dirs=(),
+                 interval_s=2.0):
+        self.root = root
+        self.include = include
+        self.exclude = exclude
+        self.recursive = recursive
+        self.onerror = onerror
+        self.exclude_dirs = exclude_dirs
+        self.interval_s = interval_s
+        self.known = {}
+        self.next_listing = 0
+
+    def start(self):
+        return self.changes(0)
+
+    def changes(self, timeout=None):
+        wait = self.next_listing - time.monotonic()
+        if timeout is not None and timeout < wait:
+            time.sleep(max(timeout, 0))
+            return []
+        time.sleep(max(wait, 0))
+        self.next_listing = time.monotonic() + self.interval_s
+
+        paths, listed = [], {}
+        for path in discover_images(self.root, self.include, self.exclude, self.recursive, self.onerror,
+                                    self.exclude_dirs):
+            signature = file_signature(path)
+            if signature is None:
+                continue
+            listed[path] = signature
+            if self.known.get(path) != signature:
+                paths.append(path)
+        self.known = listed
+        return paths
+
+    def close(self):
+        pass
+
+
+def file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def looks_complete(path):
+    # False if the file lacks the trailer its format ends with, i.e. is still being written
+    trailer = TRAILERS.get(os.path.splitext(path)[1].lower())
+    if trailer is None:
+        return True
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - 1024, 0))
+            return trailer in f.read()
+    except OSError:
+        return False
+
+
+def open_watcher(root, include=IMAGE_PATTERNS, exclude=(), recursive=False, onerror=None, exclude_dirs=(),
+                 poll_s=None):
+    # inotify where available unless poll_s, a polling interval, is given
+    if poll_s is None:
+        try:
+            return InotifyWatcher(root, include, exclude, recursive, onerror, exclude_dirs)
+        except OSError:
+            poll_s = 2.0
+    return PollingWatcher(root, include, exclude, recursive, onerror, exclude_dirs, poll_s)
+
+
+def watch_folder(input_dir, output_dir, param_values, update_status_callback=no_status, memory_budget_mb=0,
+                 instrumentation=None, include=IMAGE_PATTERNS, exclude=(), recursive=False, output_format=None,
+                 skip=None, settle_s=1.0, incomplete_s=60.0, poll_s=None, onerror=None):
+    # Processes the scans in input_dir, then every scan written there afterwards, as soon as it is complete:
+    # once its size and modification time have not changed for settle_s seconds and, for JPEG and PNG, it ends
+    # like a complete file. A scan that never does is processed anyway after incomplete_s seconds.
+    # Yields one BatchResult per scan processed, forever; close the generator to stop watching.
+    # An output_dir inside input_dir is not watched, its slices would be sliced again.
+    # skip(path), if given, tells the scans not to process, e.g. those a manifest records as done.
+    # Other arguments as in run_batch.
+    params = AutoslicerParams()
+    params.set_values(param_values)
+    slicer = Autoslicer(params)
+    slicer.memory_budget_mb = memory_budget_mb
+    slicer.instrumentation = collecting_instrumentation(instrumentation is not None and instrumentation.enabled())
+    # Scans come in one at a time, each is yielded once written, but the writer threads are kept between them
+    writer = slicer.slice_writer()
+    input_root = input_dir if recursive else None
+
+    watcher = open_watcher(input_dir, include, exclude, recursive, onerror, (output_dir,), poll_s)
+    update_status_callback(f"Watching {input_dir} with {type(watcher).__name__}")
+    # Path -> signature, time of its last change, time it was first seen
+    candidates = {}
+
+    def observe(path, now):
+        signature = file_signature(path)
+        if signature is None:
+            candidates.pop(path, None)
+        elif path not in candidates:
+            candidates[path] = (signature, now, now)
+        elif candidates[path][0] != signature:
+            candidates[path] = (signature, now, candidates[path][2])
+
+    try:
+        now = time.monotonic()
+        for path in watcher.start():
+            observe(path, now - settle_s)
+
+        while True:
+            now = time.monotonic()
+            timeout = None
+            if candidates:
+                timeout = max(min(changed for _, changed, _ in candidates.values()) + settle_s - now, 0)
+            for path in watcher.changes(timeout):
+                observe(path, time.monotonic())
+
+            now = time.monotonic()
+            for path in sorted(candidates):
+                _, changed, seen = candidates[path]
+                if now - changed < settle_s:
+                    continue
+                observe(path, now)
+                if path not in candidates or candidates[path][1] == now:
+                    # Gone or still being written
+                    continue
+                if not looks_complete(path) and now - seen < incomplete_s:
+                    candidates[path] = (candidates[path][0], now, seen)
+                    continue
+                del candidates[path]
+                if skip is not None and skip(path):
+                    continue
+
+                result = process_image_isolated(slicer, path, output_dir, update_status_callback, input_root,
+                                                output_format, writer)
+                forward_events(result, instrumentation)
+                yield result
+    finally:
+        watcher.close()
+        writer.close()
@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import random
+import socket
+import hashlib
+import threading
+
+PENDING, CLAIMED, DONE, FAILED = "pending", "claimed", "done", "failed"
+STATES = (PENDING, CLAIMED, DONE, FAILED)
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def job_id(name):
+    return hashlib.sha1(name.encode("utf-8")).hexdigest()
+
+
+class DirectoryQueue:
+    # Work queue on a filesystem shared by the workers of several machines, e.g. a NAS. Each job is a small JSON
+    # file in the directory of its state and changes state by an atomic rename, so that exactly one worker wins a
+    # claim. SQLite is not used because its locking is unreliable on network filesystems.
+    # The modification time of a claimed job is its lease, renewed by the worker holding it. A job whose lease ran
+    # out, because its worker crashed or lost the share, goes back to pending, as does a failed job, until
+    # max_attempts is reached. Leases are stamped with the clock of the workers, assumed in sync with each other (NTP).
+
+    def __init__(self, path, lease_s=300, max_attempts=3, clock=time.time):
+        self.path = path
+        self.lease_s = lease_s
+        self.max_attempts = max_attempts
+        self.clock = clock
+        for state in STATES:
+            os.makedirs(os.path.join(path, state), exist_ok=True)
+
+    def state_dir(self, state):
+        return os.path.join(self.path, state)
+
+    def job_path(self, state, name, worker_id=None):
+        file_name = job_id(name) if worker_id is None else job_id(name) + "." + worker_id
+        return os.path.join(self.path, state, file_name + ".json")
+
+    def list(self, state):
+        # Job files of a state; temporary files start with a dot
+        try:
+            return [entry for entry in os.scandir(self.state_dir(state)) if not entry.name.startswith(".")]
+        except FileNotFoundError:
+            return []
+
+    def read(self, path):
+        with open(path) as f:
+            return json.load(f)
+
+    def write(self, path, job):
+        # Replaces path atomically, readers never see a partial job
+        tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{default_worker_id()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(job, f)
+        os.replace(tmp_path, path)
+
+    def add(self, names):
+        # Queues the names not known yet in any state; returns how many were added. States are listed in the
+        # order jobs move through them, so that a job moving on meanwhile is still seen.
+        known = set()
+        for state in STATES:
+            known.update(entry.name.split(".")[0] for entry in self.list(state))
+
+        added = 0
+        for name in names:
+            if job_id(name) in known:
+                continue
+            try:
+                # O_EXCL: workers adding the same scans at the same time queue it once
+                fd = os.open(self.job_path(PENDING, name), os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            except FileExistsError:
+                continue
+            with os.fdopen(fd, "w") as f:
+                json.dump({"name": name, "attempts": 0, "added_at": self.clock()}, f)
+            added += 1
+        return added
+
+    def requeue_expired(self):
+        now = self.clock()
+        for entry in self.list(CLAIMED):
+            try:
+                if entry.stat().st_mtime + self.lease_s >= now:
+                    continue
+                os.rename(entry.path, os.path.join(self.state_dir(PENDING), entry.name.split(".")[0] + ".json"))
+            except FileNotFoundError:
+                # Completed, renewed away or requeued by another worker meanwhile
+                continue
+
+    def claim(self, worker_id):
+        # Name of the job now held by worker_id, None if no job is pending
+        self.requeue_expired()
+        entries = self.list(PENDING)
+        # Workers starting together would otherwise all race for the same first job
+        random.shuffle(entries)
+        for entry in entries:
+            claimed_path = os.path.join(self.state_dir(CLAIMED), entry.name.split(".")[0] + "." + worker_id + ".json")
+            try:
+                # The lease starts now, a rename keeps the old modification time
+                self.stamp(entry.path)
+                os.rename(entry.path, claimed_path)
+            except FileNotFoundError:
+                continue
+
+            job = self.read(claimed_path)
+            job["attempts"] += 1
+            job["worker"] = worker_id
+            if job["attempts"] > self.max_attempts:
+                job["error"] = job.get("error") or "Lease expired"
+                self.write(claimed_path, job)
+                os.rename(claimed_path, self.job_path(FAILED, job["name"]))
+                continue
+            self.write(claimed_path, job)
+            self.stamp(claimed_path)
+            return job["name"]
+        return None
+
+    def stamp(self, path):
+        now = self.clock()
+        os.utime(path, (now, now))
+
+    def renew(self, name, worker_id):
+        # False if the lease was lost, the job then went back to pending
+        try:
+            self.stamp(self.job_path(CLAIMED, name, worker_id))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, name, worker_id, outputs=(), error=None):
+        # Marks a held job done, or failed: a failed job is retried until max_attempts. False if the lease was lost.
+        # The claim is first taken over by a rename to a name of its own, atomically: past that point no other
+        # worker requeues it, until its lease runs out should this worker die before the job reaches its state.
+        completing_path = os.path.join(self.state_dir(CLAIMED), f"{job_id(name)}.{worker_id}.completing")
+        try:
+            os.rename(self.job_path(CLAIMED, name, worker_id), completing_path)
+        except FileNotFoundError:
+            return False
+
+        job = self.read(completing_path)
+        if error is None:
+            state = DONE
+        else:
+            state = PENDING if job["attempts"] < self.max_attempts else FAILED
+        # Written before the rename: once pending, the job may be claimed again right away
+        job.update(outputs=list(outputs), error=error, finished_at=self.clock())
+        self.write(completing_path, job)
+        self.stamp(completing_path)
+        os.rename(completing_path, self.job_path(state, name))
+        return True
+
+    def counts(self):
+        return {state: len(self.list(state)) for state in STATES}
+
+    def unfinished(self):
+        return len(self.list(PENDING)) > 0 or len(self.list(CLAIMED)) > 0
+
+
+class LocalQueue:
+    # In process stand-in for DirectoryQueue with the same semantics, for tests and experiments.
+    # clock may be replaced to let leases run out without waiting.
+
+    def __init__(self, lease_s=300, max_attempts=3, clock=time.time):
+        self.lease_s = lease_s
+        self.max_attempts = max_attempts
+        self.clock = clock
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def add(self, names):
+        added = 0
+        with self.lock:
+            for name in names:
+                if name not in self.jobs:
+                    self.jobs[name] = {"name": name, "state": PENDING, "attempts": 0, "worker": None, "lease_until": 0}
+                    added += 1
+        return added
+
+    def requeue_expired(self):
+        now = self.clock()
+        for job in self.jobs.values():
+            if job["state"] == CLAIMED and job["lease_until"] < now:
+                job["state"] = PENDING
+
+    def claim(self, worker_id):
+        with self.lock:
+            self.requeue_expired()
+            for job in self.jobs.values():
+                if job["state"] != PENDING:
+                    continue
+                job["attempts"] += 1
+                job["worker"] = worker_id
+                if job["attempts"] > self.max_attempts:
+                    job["state"] = FAILED
+                    job["error"] = job.get("error") or "Lease expired"
+                    continue
+                job["state"] = CLAIMED
+                job["lease_until"] = self.clock() + self.lease_s
+                return job["name"]
+        return None
+
+    def held(self, name, worker_id):
+        job = self.jobs.get(name)
+        return job is not None and job["state"] == CLAIMED and job["worker"] == worker_id
+
+    def renew(self, name, worker_id):
+        with self.lock:
+            if not self.held(name, worker_id):
+                return False
+            self.jobs[name]["lease_until"] = self.clock() + self.lease_s
+            return True
+
+    def complete(self, name, worker_id, outputs=(), error=None):
+        with self.lock:
+            if not self.held(name, worker_id):
+                return False
+            job = self.jobs[name]
+            if error is None:
+                job["state"] = DONE
+            else:
+                job["state"] = PENDING if job["attempts"] < self.max_attempts else FAILED
+            job.update(outputs=list(outputs), error=error, finished_at=self.clock())
+            return True
+
+    def counts(self):
+        with self.lock:
+            return {state: sum(1 for job in self.jobs.values() if job["state"] == state) for state in STATES}
+
+    def unfinished(self):
+        counts = self.counts()
+        return counts[PENDING] > 0 or counts[CLAIMED] > 0
+
+
+class LeaseKeeper:
+    # Renews the leases of the jobs a worker holds, from a thread, until closed
+
+    def __init__(self, queue, worker_id, interval_s=None):
+        self.queue = queue
+        self.worker_id = worker_id
+        self.interval_s = interval_s if interval_s is not None else queue.lease_s / 3
+        self.names = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def hold(self, name):
+        with self.lock:
+            self.names.add(name)
+
+    def release(self, name):
+        with self.lock:
+            self.names.discard(name)
+
+    def run(self):
+        while not self.stopped.wait(self.interval_s):
+            with self.lock:
+                names = list(self.names)
+            for name in names:
+                try:
+                    self.queue.renew(name, self.worker_id)
+                except OSError:
+                    # The share may come back before the lease runs out
+                    pass
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
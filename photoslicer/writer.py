@@ -0,0 +1,106 @@
+import os
+import queue
+import threading
+import cv2
+from instrumentation import Instrumentation
+
+
+class ScanSlices:
+    # The slices of one scan put on a SliceWriter, which may be writing those of other scans too: result() waits
+    # until they are all written and returns their paths, or raises the first error among them
+
+    def __init__(self, scan=None):
+        self.scan = scan
+        self.paths = []
+        self.remaining = 0
+        self.error = None
+        self.condition = threading.Condition()
+
+    def add(self, out_path):
+        with self.condition:
+            self.paths.append(out_path)
+            self.remaining += 1
+
+    def finish(self, error=None):
+        with self.condition:
+            self.remaining -= 1
+            if self.error is None:
+                self.error = error
+            self.condition.notify_all()
+
+    def join(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.remaining == 0)
+
+    def result(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return list(self.paths)
+
+
+class SliceWriter:
+    # Output stage: slices are rendered, encoded and written by a pool of threads fed through a bounded queue.
+    # put() takes a slice or a function rendering it; with functions every step runs in the threads, and OpenCV
+    # releases the GIL while warping and encoding, so slices are processed in parallel even when cv2 itself runs
+    # single threaded. put() blocks while queue_size slices are waiting, which bounds the memory they hold.
+    # One writer may serve a whole batch: the slices of a scan are then written while the next one is detected.
+    # Errors go to the ScanSlices of the slice if given, the other slices of that scan are skipped; the first
+    # error of slices put without one is raised by close().
+
+    def __init__(self, workers=1, queue_size=None, instrumentation=None):
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+        self.queue = queue.Queue(maxsize=queue_size if queue_size is not None else 2 * workers)
+        self.error = None
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(max(workers, 1))]
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # An error of the caller wins over ours, the threads are stopped either way
+        self.close(raise_error=exc_type is None)
+
+    def put(self, image, out_path, params=(), slices=None):
+        if slices is not None:
+            slices.add(out_path)
+        self.queue.put((image, out_path, list(params), slices))
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            image, out_path, params, slices = job
+            error = None
+            if (slices.error if slices is not None else self.error) is None:
+                try:
+                    if callable(image):
+                        image = image()
+                    self.write(image, out_path, params, slices.scan if slices is not None else None)
+                except Exception as e:
+                    error = e
+            if slices is not None:
+                slices.finish(error)
+            elif error is not None:
+                self.error = error
+
+    def write(self, image, out_path, params, scan=None):
+        ext = os.path.splitext(out_path)[1].lower()
+        with self.instrumentation.stage("encode", scan=scan, path=out_path, format=ext.lstrip(".")):
+            ok, data = cv2.imencode(ext, image, params)
+        if not ok:
+            raise IOError("Cannot encode " + out_path)
+        with self.instrumentation.stage("write", scan=scan, path=out_path, bytes=len(data)):
+            with open(out_path, "wb") as f:
+                f.write(data)
+
+    def close(self, raise_error=True):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if raise_error and self.error is not None:
+            raise self.error
@@ -0,0 +1,99 @@
+from photoslicer.autoslicer import AutoslicerParams
+from photoslicer.benchmark import run_benchmark, compare_results, format_results, save_results, load_results, \
+    run_engine_check, format_engine_deviation, run_decode_check, format_decode_check
+import getopt
+
+import sys
+
+
+def usage(argv):
+    if isinstance(argv, list):
+        print(f"Usage: {argv[0]} [OPTION]\n"
+            + "Optional auguments:\n"
+            + " -o results.json\tWrite machine-readable results\n"
+            + " -c baseline.json\tCompare against earlier results, exit status 1 on regressions\n"
+            + " -d DPIs\tdefault 150,300,600\n"
+            + " -n Photo counts per scan\tdefault 1,4,8\n"
+            + " -b Backgrounds\tdefault white,noisy\n"
+            + " -r Repetitions, best time is kept\tdefault 3\n"
+            + " -s Random seed\tdefault 0\n"
+            + " -p Autoslicer parameters\te.g. detect_scale=25,refine_edges=1\n"
+            + " -e Check the fast filter engines against the exact ones instead, exit status 1 past the bounds\n"
+            + " -l Compare decoding JPEG scans grayscale first and in colour at once instead\n"
+        )
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], 'ho:c:d:n:b:r:s:p:el')
+    except getopt.GetoptError as e:
+        print(e)
+        usage(argv)
+        return 2
+
+    param_dict = {}
+    for item in opts:
+        param_dict.update({item[0][-1]: item[1]})
+
+    if 'h' in param_dict.keys():
+        usage(argv)
+        return 0
+
+    slice_para = AutoslicerParams()
+    if 'p' in param_dict.keys():
+        for assignment in param_dict['p'].split(','):
+            name, value = assignment.split('=')
+            getattr(slice_para, name.strip()).set(int(value))
+
+    if 'e' in param_dict.keys():
+        cases, violations = run_engine_check(
+            dpis=[int(v) for v in param_dict.get('d', '150,300').split(',')],
+            photo_counts=[int(v) for v in param_dict.get('n', '4').split(',')],
+            backgrounds=param_dict.get('b', 'white,noisy').split(','),
+            param_values=slice_para.values(),
+            seed=int(param_dict.get('s', 0)))
+        print(format_engine_deviation(cases))
+        for violation in violations:
+            print("DEVIATION " + violation)
+        if violations:
+            return 1
+        print("Fast engines within bounds")
+        return 0
+
+    if 'l' in param_dict.keys():
+        cases = run_decode_check(
+            dpis=[int(v) for v in param_dict.get('d', '150,300,600').split(',')],
+            photo_counts=[int(v) for v in param_dict.get('n', '0,4').split(',')],
+            backgrounds=param_dict.get('b', 'white').split(','),
+            repeat=int(param_dict.get('r', 3)),
+            param_values=slice_para.values(),
+            seed=int(param_dict.get('s', 0)))
+        print(format_decode_check(cases))
+        return 0
+
+    results = run_benchmark(
+        dpis=[int(v) for v in param_dict.get('d', '150,300,600').split(',')],
+        photo_counts=[int(v) for v in param_dict.get('n', '1,4,8').split(',')],
+        backgrounds=param_dict.get('b', 'white,noisy').split(','),
+        repeat=int(param_dict.get('r', 3)),
+        param_values=slice_para.values(),
+        seed=int(param_dict.get('s', 0)))
+
+    print(format_results(results))
+    if 'o' in param_dict.keys():
+        save_results(results, param_dict['o'])
+
+    if 'c' in param_dict.keys():
+        regressions = compare_results(load_results(param_dict['c']), results)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            return 1
+        print("No regressions")
+
+    return 0
+
+
+if __name__ == "__main__":
+    argv = sys.argv
+    sys.exit(main(argv))
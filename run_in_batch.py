@@ -1,10 +1,15 @@
 from photoslicer.autoslicer import AutoslicerParams, Autoslicer
+from photoslicer.batch import run_batch, run_queue, queue_name
+from photoslicer.instrumentation import Instrumentation, JsonLinesSink, SummarySink
+from photoslicer.discovery import IMAGE_PATTERNS, discover_images, split_patterns
+from photoslicer.manifest import Manifest
+from photoslicer.workqueue import DirectoryQueue
+from photoslicer.watch import watch_folder
+from photoslicer.slicecache import hash_params
 import getopt
 
 import os
-import re
 import sys
-image_regex="[\w-]+\.(?i:gif|jpe?g|tiff|bmp|png)$"
 
 def usage(argv):
     if isinstance(argv, list):
@@ -20,26 +25,117 @@ def usage(argv):
             + " -n BBox min surfac (% total)\tdefault 2, min 0, max 100\n"
             + " -f BBOX fill thresh\tdefault 10, min 0, max 100\n"
             + " -k Dilate kernel size (0=disabled)\tdefault 0, min 0, max 500\n"
+            + " -s Detection resolution (% full)\tdefault 100, min 5, max 100\n"
+            + " -r Refine edges at full resolution\tdefault 0, min 0, max 1\n"
+            + " -M Memory budget per scan in MB, larger scans are loaded tiled (0=disabled)\tdefault 0\n"
+            + " -j events.jsonl\tAppend per-stage timing events as JSON lines\n"
+            + " -S\tPrint a per-stage timing summary at the end\n"
+            + " -w Worker processes (0=all cores)\tdefault 1\n"
+            + " -R\tRecurse into subdirectories, slices go to the matching subdirectory of output_dir\n"
+            + " -I patterns\tComma separated file name patterns to include\tdefault " + ",".join(IMAGE_PATTERNS) + "\n"
+            + " -X patterns\tComma separated file or directory name patterns to exclude\n"
+            + " -F\tForce reprocessing of the scans the output dir manifest records as done\n"
+            + " -e format\tSlice file format, e.g. jpg, png or webp\tdefault: the format of each scan\n"
+            + " -q JPEG quality\tdefault 95, min 0, max 100\n"
+            + " -P Progressive JPEG\tdefault 0, min 0, max 1\n"
+            + " -z PNG compression level (0=fastest)\tdefault 3, min 0, max 9\n"
+            + " -W WebP quality (101=lossless)\tdefault 90, min 1, max 101\n"
+            + " -Q queue_dir\tShare the scans with workers on other machines through a queue directory on the share\n"
+            + " -L Queue lease in seconds, a scan held longer by a silent worker is retried\tdefault 300\n"
+            + " -D\tKeep watching input_dir and process each new scan once it is written, until interrupted\n"
+            + " -d Seconds a new scan must stay unchanged before it is processed\tdefault 1\n"
+            + " -Y Watch by listing input_dir every N seconds instead of inotify, e.g. on a network share\n"
         )
 
-def run(input_dir, output_dir, slice_para):
-    file_list = os.listdir(input_dir)
-    image_list = [os.path.join(input_dir, file_item) for file_item in file_list  if len(re.findall(image_regex, file_item))>0]
-    slicer = Autoslicer(params=slice_para)
+def run(input_dir, output_dir, slice_para, workers=1, memory_budget_mb=0, events_path=None, summary=False,
+        recursive=False, include=IMAGE_PATTERNS, exclude=(), force=False, output_format=None, queue_dir=None,
+        lease_s=300, watch=False, settle_s=1.0, poll_s=None):
+    # Scans are processed while the input tree is still being listed. An output dir inside the input tree is not
+    # walked, its slices would be sliced again.
+    image_files = discover_images(input_dir, include, exclude, recursive,
+                                  onerror=lambda e: print(f"Cannot list {e.filename}: {e.strerror}"),
+                                  exclude_dirs=(output_dir,))
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    for image_file in image_list:
-        slicer.load_image(image_file)
-        bboxes , image = slicer.autodetect_slices(update_status_callback=print)
-        for i_slice, bbox in enumerate(bboxes):
-            slicer.save_slice(bbox, os.path.join(output_dir, os.path.basename(image_file)[:-4]+f"_{i_slice}"+image_file[-4:]))
+    # Scans done in an earlier run, unchanged and with the same parameters, are skipped unless forced.
+    # With a queue, the queue records what is done instead: SQLite is unsafe with writers on several machines.
+    param_values = slice_para.values()
+    manifest_values = dict(param_values, output_format=output_format)
+    manifest = Manifest.in_output_dir(output_dir) if queue_dir is None else None
+    skipped = []
+    if manifest is not None and not force:
+        image_files = manifest.pending(image_files, manifest_values, skipped)
+
+    instrumentation = Instrumentation()
+    if events_path is not None:
+        instrumentation.add_sink(JsonLinesSink(events_path))
+    summary_sink = SummarySink()
+    if summary:
+        instrumentation.add_sink(summary_sink)
+
+    input_root = input_dir if recursive else None
+    if watch:
+        # The scans already there are processed first, those done in an earlier run skipped unless forced
+        params_hash = hash_params(manifest_values)
+
+        def done_before(image_file):
+            if manifest.is_done(image_file, params_hash):
+                skipped.append(image_file)
+                return True
+            return False
+
+        results = watch_folder(input_dir, output_dir, param_values, update_status_callback=print,
+                               memory_budget_mb=memory_budget_mb, instrumentation=instrumentation,
+                               include=include, exclude=exclude, recursive=recursive, output_format=output_format,
+                               skip=None if force or manifest is None else done_before,
+                               settle_s=settle_s, poll_s=poll_s,
+                               onerror=lambda e: print(f"Cannot watch {e.filename}: {e.strerror}"))
+    elif queue_dir is None:
+        results = run_batch(image_files, output_dir, param_values, workers, update_status_callback=print,
+                            memory_budget_mb=memory_budget_mb, instrumentation=instrumentation,
+                            input_root=input_root, output_format=output_format)
+    else:
+        # Every worker adds the scans it finds; scans already queued, done or failed are not added again
+        work_queue = DirectoryQueue(queue_dir, lease_s)
+        added = work_queue.add(queue_name(image_file, input_dir) for image_file in image_files)
+        print(f"Queued {added} new scans in {queue_dir}")
+        results = run_queue(work_queue, input_dir, output_dir, param_values, workers, update_status_callback=print,
+                            memory_budget_mb=memory_budget_mb, instrumentation=instrumentation,
+                            input_root=input_root, output_format=output_format)
+
+    processed = 0
+    failed = 0
+    try:
+        for result in results:
+            processed += 1
+            if manifest is not None:
+                manifest.record(result, manifest_values)
+            if result.ok():
+                print(f"{result.image_file}: {len(result.outputs)} slices")
+            else:
+                failed += 1
+                print(f"{result.image_file}: FAILED {result.error}")
+    except KeyboardInterrupt:
+        # How a watch ends
+        results.close()
+
+    if manifest is not None:
+        manifest.close()
+        print(f"Processed {processed} images, {failed} failed, {len(skipped)} unchanged skipped")
+    else:
+        counts = work_queue.counts()
+        print(f"Processed {processed} images here, {failed} failed; queue: {counts['done']} done, "
+              f"{counts['failed']} failed for good")
+    if summary:
+        print(summary_sink.format())
+    instrumentation.close()
 
 
 def main(argv):
     
     if True:
-        opts, args = getopt.getopt(argv[1:], 'i:o:')
+        opts, args = getopt.getopt(argv[1:], 'i:o:g:m:t:b:n:f:k:s:r:M:w:j:SRI:X:Fe:q:P:z:W:Q:L:Dd:Y:')
         param_dict = {}
         for item in opts:
             param_dict.update({item[0][-1]:item[1]})
@@ -69,14 +165,62 @@ def main(argv):
             slice_para.bw_thresh.set(int(param_dict['t']))
         if 'b' in param_dict.keys() :
             slice_para.bw_gauss.set(int(param_dict['b']))
-        if 'm' in param_dict.keys() :
-            slice_para.bbox_min_size_prop.set(int(param_dict['m']))
+        if 'n' in param_dict.keys() :
+            slice_para.bbox_min_size_prop.set(int(param_dict['n']))
         if 'f' in param_dict.keys() :
             slice_para.bbox_fill_thresh.set(int(param_dict['f']))
         if 'k' in param_dict.keys() :
             slice_para.dilate_kernel.set(int(param_dict['k']))
+        if 's' in param_dict.keys() :
+            slice_para.detect_scale.set(int(param_dict['s']))
+        if 'r' in param_dict.keys() :
+            slice_para.refine_edges.set(int(param_dict['r']))
+        if 'q' in param_dict.keys() :
+            slice_para.jpeg_quality.set(int(param_dict['q']))
+        if 'P' in param_dict.keys() :
+            slice_para.jpeg_progressive.set(int(param_dict['P']))
+        if 'z' in param_dict.keys() :
+            slice_para.png_compression.set(int(param_dict['z']))
+        if 'W' in param_dict.keys() :
+            slice_para.webp_quality.set(int(param_dict['W']))
 
         config_dict.update({'slice_para': slice_para})
+
+        if 'w' in param_dict.keys() :
+            config_dict.update({'workers': int(param_dict['w'])})
+        if 'M' in param_dict.keys() :
+            config_dict.update({'memory_budget_mb': int(param_dict['M'])})
+        if 'j' in param_dict.keys() :
+            config_dict.update({'events_path': param_dict['j']})
+        if 'S' in param_dict.keys() :
+            config_dict.update({'summary': True})
+        if 'R' in param_dict.keys() :
+            config_dict.update({'recursive': True})
+        if 'I' in param_dict.keys() :
+            config_dict.update({'include': split_patterns(param_dict['I'])})
+        if 'X' in param_dict.keys() :
+            config_dict.update({'exclude': split_patterns(param_dict['X'])})
+        if 'F' in param_dict.keys() :
+            config_dict.update({'force': True})
+        if 'e' in param_dict.keys() :
+            config_dict.update({'output_format': param_dict['e']})
+        if 'Q' in param_dict.keys() :
+            config_dict.update({'queue_dir': param_dict['Q']})
+        if 'L' in param_dict.keys() :
+            config_dict.update({'lease_s': int(param_dict['L'])})
+        if 'D' in param_dict.keys() :
+            if 'Q' in param_dict.keys() :
+                print("-D and -Q cannot be combined: a watch processes the scans of its own folder")
+                usage(argv)
+                return
+            if 'w' in param_dict.keys() :
+                print("-w is ignored with -D: a watch processes one scan at a time, as it arrives")
+                config_dict.pop('workers', None)
+            config_dict.update({'watch': True})
+        if 'd' in param_dict.keys() :
+            config_dict.update({'settle_s': float(param_dict['d'])})
+        if 'Y' in param_dict.keys() :
+            config_dict.update({'poll_s': float(param_dict['Y'])})
         
         #print('config dict: ',config_dict)
         #print(f'Options Tuple is {opts}')
@@ -84,7 +228,6 @@ def main(argv):
     #except:
     #    print("Input error.")
     #    usage(argv)
-        return
     run(**config_dict)
 
 if __name__ == "__main__":
@@ -0,0 +1,77 @@
+from photoslicer.autoslicer import AutoslicerParams
+from photoslicer.discovery import discover_images
+from photoslicer.sweep import parse_grid, parameter_grid, random_combinations, sample_scans, run_sweep, rank, \
+    format_report, save_report
+import getopt
+
+import sys
+
+
+def usage(argv):
+    if isinstance(argv, list):
+        print(f"Usage: {argv[0]} [OPTION]\n"
+            + "Mandatory auguments:\n"
+            + " -i input_dir\tDirectory of sample scans\n"
+            + " -g grid\tValues to try, e.g. gaussian=10:20:30,bw_thresh=190:210:230\n"
+            + "Optional auguments:\n"
+            + " -n Scans sampled from input_dir\tdefault 20\n"
+            + " -r Random combinations sampled from the grid\tdefault: the whole grid\n"
+            + " -x Photos expected per scan, ranks by count error first\n"
+            + " -p Fixed Autoslicer parameters\te.g. detect_scale=25,refine_edges=1\n"
+            + " -w Worker processes (0=all cores)\tdefault 0\n"
+            + " -t Rows shown\tdefault 20\n"
+            + " -s Random seed\tdefault 0\n"
+            + " -o report.json\tWrite every combination with its metrics\n"
+        )
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], 'hi:g:n:r:x:p:w:t:s:o:')
+    except getopt.GetoptError as e:
+        print(e)
+        usage(argv)
+        return 2
+
+    param_dict = {}
+    for item in opts:
+        param_dict.update({item[0][-1]: item[1]})
+
+    if 'h' in param_dict.keys() or 'i' not in param_dict.keys() or 'g' not in param_dict.keys():
+        usage(argv)
+        return 0 if 'h' in param_dict.keys() else 2
+
+    slice_para = AutoslicerParams()
+    if 'p' in param_dict.keys():
+        for assignment in param_dict['p'].split(','):
+            name, value = assignment.split('=')
+            getattr(slice_para, name.strip()).set(int(value))
+
+    seed = int(param_dict.get('s', 0))
+    grid = parse_grid(param_dict['g'])
+    base_values = slice_para.values()
+    if 'r' in param_dict.keys():
+        combinations = random_combinations(base_values, grid, int(param_dict['r']), seed)
+    else:
+        combinations = list(parameter_grid(base_values, grid))
+
+    image_files = sample_scans(discover_images(param_dict['i'], recursive=False), int(param_dict.get('n', 20)), seed)
+    print(f"Sweeping {len(combinations)} combinations over {len(image_files)} scans")
+
+    skipped = []
+    rows = run_sweep(image_files, combinations, int(param_dict.get('w', 0)), skipped=skipped)
+    if skipped:
+        print(f"{len(skipped)} scans could not be evaluated and are left out:")
+        for image_file, error in skipped:
+            print(f"  {image_file}: {error}")
+    rows = rank(rows, int(param_dict['x']) if 'x' in param_dict.keys() else None)
+    print(format_report(rows, list(grid), int(param_dict.get('t', 20))))
+    if 'o' in param_dict.keys():
+        save_report(rows, param_dict['o'])
+
+    return 0
+
+
+if __name__ == "__main__":
+    argv = sys.argv
+    sys.exit(main(argv))
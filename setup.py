@@ -22,7 +22,7 @@ setup(
     ],
     packages=["photoslicer"],
     include_package_data=True,
-    install_requires=["Pillow", "shapely", "opencv-python", "numpy"],
+    install_requires=["Pillow", "shapely>=2", "opencv-python", "numpy"],
     entry_points={
         "console_scripts": [
             "photoslicer=photoslicer.__main__:main"
@@ -0,0 +1,74 @@
+import time
+import pytest
+from photoslicer.workqueue import DirectoryQueue, LocalQueue, PENDING, CLAIMED, DONE, FAILED
+
+
+class FakeClock:
+    # Time that only moves when told to, so that leases run out without waiting
+
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+    def tick(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+# The in-process stand-in and a directory queue behave the same
+@pytest.fixture(params=["local", "directory"])
+def work_queue(request, tmp_path, clock):
+    if request.param == "local":
+        return LocalQueue(lease_s=60, max_attempts=2, clock=clock)
+    return DirectoryQueue(str(tmp_path), lease_s=60, max_attempts=2, clock=clock)
+
+
+def test_add_and_claim(work_queue):
+    assert work_queue.add(["a", "b"]) == 2
+    assert work_queue.add(["a"]) == 0
+    assert sorted([work_queue.claim("w1"), work_queue.claim("w2")]) == ["a", "b"]
+    assert work_queue.claim("w3") is None
+    assert work_queue.counts() == {PENDING: 0, CLAIMED: 2, DONE: 0, FAILED: 0}
+
+
+def test_lost_lease(work_queue, clock):
+    work_queue.add(["a", "b"])
+    first, second = work_queue.claim("w1"), work_queue.claim("w2")
+
+    # Renewed halfway, the first lease outlives the second
+    clock.tick(30)
+    assert work_queue.renew(first, "w1")
+    clock.tick(31)
+    assert work_queue.claim("w3") == second
+    assert not work_queue.renew(second, "w2")
+    assert not work_queue.complete(second, "w2")
+
+    assert work_queue.complete(first, "w1", ["out.jpg"])
+    assert work_queue.complete(second, "w3")
+    assert work_queue.counts() == {PENDING: 0, CLAIMED: 0, DONE: 2, FAILED: 0}
+    assert not work_queue.unfinished()
+
+
+def test_retries(work_queue, clock):
+    work_queue.add(["a", "b"])
+
+    # A failed first attempt is retried, a failed second one is the last
+    first, second = work_queue.claim("w1"), work_queue.claim("w2")
+    assert work_queue.complete(first, "w1", error="boom")
+    assert work_queue.complete(second, "w2", error="boom")
+    assert work_queue.counts()[PENDING] == 2
+    first, second = work_queue.claim("w1"), work_queue.claim("w2")
+    assert sorted([first, second]) == ["a", "b"]
+    assert work_queue.complete(first, "w1", error="boom")
+
+    # A crashed worker uses up an attempt too
+    clock.tick(61)
+    assert work_queue.claim("w3") is None
+    assert work_queue.counts() == {PENDING: 0, CLAIMED: 0, DONE: 0, FAILED: 2}
+    assert not work_queue.unfinished()